@@ -1,81 +1,83 @@
-from grid import Tile
+from bitboard import BitboardState, cell_bits, empty_mask, mask_cells, move_functions, move_grid, pack
+from symmetry import canonicalize, from_canonical, to_canonical
+from transposition import TranspositionTable
+from ntuple import NTupleNetwork
+from profiling import Profiler
 
-from collections import deque
-from copy import deepcopy
+import multiprocessing
 import random
 import time
-
-times = {}
-
-def reset_times():
-    global times
-    for k in times:
-        times[k] = 0
-
-def start_timer(name):
-    global times
-    times["START_" + name] = time.time()
-
-def stop_timer(name):
-    global times
-    if name in times:
-        times[name] += time.time() - times["START_" + name]
-    else:
-        times[name] = time.time() - times["START_" + name]
-
-def print_times():
-    global times
-    for k in times:
-        if not k.startswith("START_"):
-            print(f"{k}: {times[k]}")
-
+from time import perf_counter_ns
 
 class State:
+    __slots__ = ("grid", "merges", "score", "_empty_positions", "_valid_moves")
+
     def __init__(self, grid=[], merges=0, state=None):
         self.grid = grid
         self.merges = merges
         self.score = 0
+        # Derived from grid on first access, see invalidate()
+        self._empty_positions = None
+        self._valid_moves = None
         if state is not None:
             self.score = state.score
-            self.grid = deepcopy(state.grid)
+            self.grid = [row[:] for row in state.grid]
             self.merges = state.merges
+            self._copy_derived(state)
+
+    @property
+    def size(self):
+        return len(self.grid)
+
+    @property
+    def empty_positions(self):
+        if self._empty_positions is None:
+            self._empty_positions = self._get_empty_positions()
+        return self._empty_positions
+
+    @property
+    def valid_moves(self):
+        if self._valid_moves is None:
+            self._valid_moves = self._get_move_directions()
+        return self._valid_moves
+
+    def invalidate(self):
+        """Drops the cached empty_positions and valid_moves. Call this after
+        changing grid directly rather than through set_tile"""
+        self._empty_positions = None
+        self._valid_moves = None
+
+    def _copy_derived(self, state):
+        if isinstance(state, State):
+            if state._empty_positions is not None:
+                self._empty_positions = set(state._empty_positions)
+            else:
+                self._empty_positions = None
+            if state._valid_moves is not None:
+                self._valid_moves = set(state._valid_moves)
+            else:
+                self._valid_moves = None
+        else:
+            self.invalidate()
 
-        self.empty_positions = self._get_empty_positions()
-        self.valid_moves = self._get_move_directions()
-
-    def from_tiles(self, tiles):
-        self.grid = []
-        for row in tiles:
-            num_row = []
-            for tile in row:
-                if tile is not None:
-                    num_row.append(tile.value)
-                else:
-                    num_row.append(0)
-            self.grid.append(num_row)
-                
-    def move_tile_in_place(self, new_grid, src_x, src_y, dest_x, dest_y):
-        start_timer("move_in_place")
-        val = new_grid[src_y][src_x]
-        new_grid[dest_y][dest_x] += val
-        new_grid[src_y][src_x] = 0
-        self.empty_positions.discard((dest_y, dest_x))
-        self.empty_positions.add((src_y, src_x))
-        stop_timer("move_in_place")
-
-    def move_tile(self, new_grid, src_x, src_y, dest_x, dest_y):
-        val = new_grid[src_y][src_x]
-        new_grid[dest_y][dest_x] += val
-        new_grid[src_y][src_x] = 0
+    def key(self):
+        return pack(self.grid)
 
     def set_from(self, state):
-        for r, row in enumerate(state.grid):
-            for c, x in enumerate(row):
-                self.grid[r][c] = x
+        for row, src in zip(self.grid, state.grid):
+            row[:] = src
         self.merges = state.merges
-        self.empty_positions = state.empty_positions
-        self.valid_moves = state.valid_moves
         self.score = state.score
+        self._copy_derived(state)
+
+    def set_tile(self, y, x, value):
+        self.grid[y][x] = value
+        if self._empty_positions is not None:
+            if value:
+                self._empty_positions.discard((y, x))
+            else:
+                self._empty_positions.add((y, x))
+        self._valid_moves = None
 
     def add_random_tile(self):
         y, x = random.choice(list(self.empty_positions))
@@ -85,8 +87,8 @@ class State:
         else:
             self.grid[y][x] = 2
             self.score += 2
-        self.empty_positions.discard((y,x))
-        self.valid_moves = self._get_move_directions()
+        self._empty_positions.discard((y,x))
+        self._valid_moves = None
 
 
     def _get_move_directions(self):
@@ -126,180 +128,18 @@ class State:
         return empty_pos
 
     def transition_in_place(self, direction):
-        # Update grid representation
-        merges = 0
-        if direction == 'LEFT':
-            for y in range(len(self.grid)):
-                prev_idx = 0
-                for x in range(1, len(self.grid[y])):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[y][prev_idx] == 0:
-                            self.move_tile_in_place(self.grid, x, y, prev_idx, y)
-                        elif self.grid[y][prev_idx] == cur_tile and prev_idx != x:
-                            # Check Merge
-                            self.move_tile_in_place(self.grid, x, y, prev_idx, y)
-                            merges += 1
-                            prev_idx += 1
-                        elif self.grid[y][prev_idx + 1] == 0:
-                            # Move into adj
-                            self.move_tile_in_place(self.grid, x, y, prev_idx + 1, y)
-                            prev_idx += 1
-                        else:
-                            prev_idx = x
-        elif direction == 'RIGHT':
-            for y in range(len(self.grid)):
-                prev_idx = len(self.grid) - 1
-                for x in range(len(self.grid[y]) - 2, -1, -1):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[y][prev_idx] == 0:
-                            self.move_tile_in_place(self.grid, x, y, prev_idx, y)
-                        elif self.grid[y][prev_idx] == cur_tile and prev_idx != x:
-                            # Check Merge
-                            self.move_tile_in_place(self.grid, x, y, prev_idx, y)
-                            merges += 1
-                            prev_idx -= 1
-                        elif self.grid[y][prev_idx - 1] == 0:
-                            # Move into adj
-                            self.move_tile_in_place(self.grid, x, y, prev_idx - 1, y)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = x
-        elif direction == 'DOWN':
-            for x in range(len(self.grid)):
-                prev_idx = 0
-                for y in range(1, len(self.grid)):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[prev_idx][x] == 0:
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx)
-                        elif self.grid[prev_idx][x] == cur_tile and prev_idx != y:
-                            # Check Merge
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx)
-                            merges += 1
-                            prev_idx += 1
-                        elif self.grid[prev_idx + 1][x] == 0:
-                            # Move into adj
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx + 1)
-                            prev_idx += 1
-                        else:
-                            prev_idx = y
-        elif direction == 'UP':
-            for x in range(len(self.grid)):
-                prev_idx = len(self.grid) - 1
-                for y in range(len(self.grid) - 2, -1, -1):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[prev_idx][x] == 0:
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx)
-                        elif self.grid[prev_idx][x] == cur_tile and prev_idx != y:
-                            # Check Merge
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx)
-                            merges += 1
-                            prev_idx -= 1
-                        elif self.grid[prev_idx - 1][x] == 0:
-                            # Move into adj
-                            self.move_tile_in_place(self.grid, x, y, x, prev_idx - 1)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = y
+        new_grid, merges = move_grid(self.grid, direction)
+        for row, new_row in zip(self.grid, new_grid):
+            row[:] = new_row
         self.merges += merges
-        #start_timer("get_moves")
-        # self.valid_moves = self._get_move_directions()
-        # stop_timer("get_moves")
+        self.invalidate()
         return self
-        
 
     def transition(self, direction):
-        # Update grid representation
-        new_grid = [[x for x in row] for row in self.grid]
-        merges = 0
-        if direction == 'LEFT':
-            for y in range(len(new_grid)):
-                prev_idx = 0
-                for x in range(1, len(new_grid[y])):
-                    cur_tile = new_grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if new_grid[y][prev_idx] == 0:
-                            self.move_tile(new_grid, x, y, prev_idx, y)
-                        elif new_grid[y][prev_idx] == cur_tile and prev_idx != x:
-                            # Check Merge
-                            self.move_tile(new_grid, x, y, prev_idx, y)
-                            merges += 1
-                            prev_idx += 1
-                        elif new_grid[y][prev_idx + 1] == 0:
-                            # Move into adj
-                            self.move_tile(new_grid, x, y, prev_idx + 1, y)
-                            prev_idx += 1
-                        else:
-                            prev_idx = x
-        elif direction == 'RIGHT':
-            for y in range(len(new_grid)):
-                prev_idx = len(self.grid) - 1
-                for x in range(len(new_grid[y]) - 2, -1, -1):
-                    cur_tile = new_grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if new_grid[y][prev_idx] == 0:
-                            self.move_tile(new_grid, x, y, prev_idx, y)
-                        elif new_grid[y][prev_idx] == cur_tile and prev_idx != x:
-                            # Check Merge
-                            self.move_tile(new_grid, x, y, prev_idx, y)
-                            merges += 1
-                            prev_idx -= 1
-                        elif new_grid[y][prev_idx - 1] == 0:
-                            # Move into adj
-                            self.move_tile(new_grid, x, y, prev_idx - 1, y)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = x
-        elif direction == 'DOWN':
-            for x in range(len(new_grid)):
-                prev_idx = 0
-                for y in range(1, len(new_grid)):
-                    cur_tile = new_grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if new_grid[prev_idx][x] == 0:
-                            self.move_tile(new_grid, x, y, x, prev_idx)
-                        elif new_grid[prev_idx][x] == cur_tile and prev_idx != y:
-                            # Check Merge
-                            self.move_tile(new_grid, x, y, x, prev_idx)
-                            merges += 1
-                            prev_idx += 1
-                        elif new_grid[prev_idx + 1][x] == 0:
-                            # Move into adj
-                            self.move_tile(new_grid, x, y, x, prev_idx + 1)
-                            prev_idx += 1
-                        else:
-                            prev_idx = y
-        elif direction == 'UP':
-            for x in range(len(new_grid)):
-                prev_idx = len(self.grid) - 1
-                for y in range(len(new_grid) - 2, -1, -1):
-                    cur_tile = new_grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if new_grid[prev_idx][x] == 0:
-                            self.move_tile(new_grid, x, y, x, prev_idx)
-                        elif new_grid[prev_idx][x] == cur_tile and prev_idx != y:
-                            # Check Merge
-                            self.move_tile(new_grid, x, y, x, prev_idx)
-                            merges += 1
-                            prev_idx -= 1
-                        elif new_grid[prev_idx - 1][x] == 0:
-                            # Move into adj
-                            self.move_tile(new_grid, x, y, x, prev_idx - 1)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = y
-        return State(new_grid, merges=self.merges + merges)
+        new_grid, merges = move_grid(self.grid, direction)
+        next_state = State(new_grid, merges=self.merges + merges)
+        next_state.score = self.score
+        return next_state
 
     def is_dead(self):
         return len(self.empty_positions) == 0
@@ -319,12 +159,49 @@ class State:
     def full_stats(self):
         return f"{'-' * 20}\n{str(self)}\nmerges: {self.merges}\ndirs: {self.valid_moves}\nempty: {self.empty_positions}\n{'-' * 20}"
         
+class StatePool:
+    """Recycles states of one class so search nodes and rollouts can reuse
+    their grids instead of allocating and collecting a copy per node.
+
+    acquire(state) returns a pooled state overwritten with state's contents
+    and release hands it back; nothing may hold on to a released state, and
+    only states from acquire may be released, or the pool grows for good.
+    """
+    def __init__(self, state_class=State, size=4, preallocate=0):
+        self.state_class = state_class
+        self.size = size
+        self.free = [self._new() for _ in range(preallocate)]
+
+    def _new(self):
+        return self.state_class([[0 for _ in range(self.size)] for _ in range(self.size)])
+
+    def acquire(self, state=None):
+        pooled = self.free.pop() if self.free else self._new()
+        if state is not None:
+            pooled.set_from(state)
+        return pooled
+
+    def release(self, state):
+        self.free.append(state)
+
+    def __len__(self):
+        return len(self.free)
+
+
 class Node:
-    def __init__(self, state, parent, depth):
-        self.state = state
+    """A search node holding a packed board, with its parent as an index into
+    the search's node list (-1 for the root) and its empty cells as a
+    size * size bit mask"""
+    __slots__ = ("board", "merges", "score", "depth", "parent", "best_child", "empty")
+
+    def __init__(self, board, merges, score, depth, parent, size=4):
+        self.board = board
+        self.merges = merges
+        self.score = score
         self.depth = depth
         self.parent = parent
         self.best_child = -1
+        self.empty = empty_mask(board, size)
 
 
 def max_to_corner(state):
@@ -377,7 +254,6 @@ def max_to_corner(state):
 
 def adj_tiles(state):
     count = 0
-    values = []
     for r in range(len(state.grid)):
         for c in range(len(state.grid[r])):
             cur = state.grid[r][c]
@@ -385,11 +261,6 @@ def adj_tiles(state):
                above = state.grid[r-1][c] 
                if above == cur:
                    count += 1
-                   values.append(cur)
-            if c > 0:
-                left = state.grid[r][c-1]
-                if left == cur:
-                    values.append(cur)
     return count
 
 
@@ -406,28 +277,154 @@ def tile_density(state):
     return tile_density
 
 
+class SearchTimeout(Exception):
+    """Raised inside a search once its deadline has passed"""
+
+
 class Agent:
-    def __init__(self, max_depth=3):
+    """Searches to max_depth, maximizing over both moves and spawns.
+
+    value_state scores boards by their merge count unless an evaluator is
+    given, which is anything with an evaluate(board) method taking a packed
+    board, such as an NTupleNetwork or a HeuristicEvaluator. It can also be
+    "heuristic" for a HeuristicEvaluator with the default weights, or the
+    path of saved n-tuple weights. Both evaluators only understand 4x4
+    boards, and get_move raises ValueError on any other size; without one
+    the agents play any size from 3x3 to 8x8.
+
+    Weights from train.py value an afterstate by the reward still to come,
+    and train.py plays the move with the best reward plus afterstate value.
+    value_state adds none of the merge rewards collected on the way to a
+    leaf, so here the weights only rank the boards a search reaches, by
+    their prospects from there, and aren't values of the paths to them.
+    """
+    def __init__(self, max_depth=3, cache_size=None, cache_replacement="lru", time_limit=None,
+                 evaluator=None):
+        if evaluator == "heuristic":
+            # Imported here so agents that don't batch never load numpy
+            from heuristics import HeuristicEvaluator
+            evaluator = HeuristicEvaluator()
+        elif isinstance(evaluator, str):
+            evaluator = NTupleNetwork.load(evaluator)
+        self.evaluator = evaluator
         self.directions = ["LEFT", "DOWN", "RIGHT", "UP"]
         self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.verbose = True
+        self.profiler = Profiler()
+        self.pools = {}
+        self.deadline = None
+        self.depth_reached = 0
+        self.previous_best = None
         self.states_considered = 0
+        self.cache = None
+        if cache_size:
+            self.cache = TranspositionTable(cache_size, replacement=cache_replacement)
+
+    def state_key(self, state):
+        """Returns (key, symmetry) for caching the search result of a state.
+
+        The board is canonicalized over its 8 symmetries, so cached directions
+        are stored relative to the canonical board. Everything value_state
+        looks at has to be part of the key, hence the merges, which an
+        evaluator ignores, so then the board alone is the key.
+        """
+        board, symmetry = canonicalize(state.key(), state.size)
+        if self.evaluator is not None:
+            return board, symmetry
+        return (board, state.merges), symmetry
+
+    def check_evaluator(self, state):
+        """Raises ValueError if the evaluator can't value state's board size"""
+        if self.evaluator is not None and state.size != 4:
+            raise ValueError(f"{type(self.evaluator).__name__} only values 4x4 boards, "
+                             f"not {state.size}x{state.size}")
 
     def value_state(self, state):
         self.states_considered += 1
+        if self.evaluator is not None:
+            return self.evaluator.evaluate(state.key())
         value = state.merges
         # value = sum([sum(row) for row in state.grid]) + 2**adj_tiles(state)
         # value = max_to_corner(state)
         # value = tile_density(state)
         return value
 
+    def clone(self, state):
+        """Returns a copy of state from this agent's pool, see release()"""
+        key = (type(state), state.size)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = StatePool(type(state), state.size)
+        return pool.acquire(state)
+
+    def release(self, state):
+        pool = self.pools.get((type(state), state.size))
+        if pool is not None:
+            pool.release(state)
+
     def get_random_successors(self, state):
         for y, x in list(state.empty_positions):
             for val in [2, 4]:
-                rand_state = State(state=state)
-                rand_state.grid[y][x] = val
+                rand_state = type(state)(state=state)
+                rand_state.set_tile(y, x, val)
                 yield rand_state
 
+    def cache_lookup(self, state, depth):
+        """Returns (entry, key, symmetry), entry being a cached (value, direction) or None"""
+        key, symmetry = self.state_key(state)
+        entry = self.cache.get(key, depth)
+        if entry is not None:
+            v, direction = entry
+            entry = v, direction and from_canonical(direction, symmetry)
+        return entry, key, symmetry
+
+    def cache_store(self, key, symmetry, depth, value, direction):
+        self.cache.put(key, depth, (value, direction and to_canonical(direction, symmetry)))
+
+    def check_deadline(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    def search(self, state):
+        """Runs find_best to max_depth. With a time_limit it instead deepens one
+        ply at a time, up to max_depth if that isn't None, until the deadline
+        passes and returns the result of the deepest search that finished.
+        previous_best is the direction the last finished iteration chose.
+        """
+        self.previous_best = None
+        if self.time_limit is None:
+            self.depth_reached = self.max_depth
+            return self.find_best(state, MAX_DEPTH=self.max_depth)
+        self.deadline = time.perf_counter() + self.time_limit
+        valid_directions = [d for d in self.directions if state.can_move(d)]
+        result = (None, valid_directions[0] if valid_directions else None)
+        self.depth_reached = 0
+        try:
+            depth = 1
+            while valid_directions and (self.max_depth is None or depth <= self.max_depth):
+                result = self.find_best(state, MAX_DEPTH=depth)
+                self.previous_best = result[1]
+                self.depth_reached = depth
+                depth += 1
+        except SearchTimeout:
+            pass
+        finally:
+            self.deadline = None
+        return result
+
+    def search_stats(self):
+        """Returns extra statistics about the last search for its report"""
+        return {}
+
     def find_best(self, state, MAX_DEPTH=3):
+        self.check_deadline()
+        # Leaves are cheaper to evaluate than to look up
+        use_cache = self.cache is not None and MAX_DEPTH > 0
+        if use_cache:
+            entry, key, symmetry = self.cache_lookup(state, MAX_DEPTH)
+            if entry is not None:
+                return entry
         value = self.value_state(state)
         if MAX_DEPTH == 0 or not state.is_able_to_move():
             return value, None
@@ -438,58 +435,292 @@ class Agent:
                 next_state = state.transition(direction)
                 for y, x in list(state.empty_positions):
                     for val, chance  in [(2, .9), (4, .1)]:
-                        succ = State(state=next_state)
-                        succ.grid[y][x] = val
+                        succ = self.clone(next_state)
+                        succ.set_tile(y, x, val)
                         v, _ = self.find_best(succ, MAX_DEPTH - 1) 
+                        self.release(succ)
                         v *= chance
                         if v > max_v:
                             max_v = v
                             best_dir = direction
+        if use_cache:
+            self.cache_store(key, symmetry, MAX_DEPTH, max_v, best_dir)
         return max_v, best_dir
 
     def get_move(self, state):
+        self.check_evaluator(state)
         start_time = time.time()
         self.states_considered = 0
-        val, direction = self.find_best(state, MAX_DEPTH=self.max_depth)
-        print(f"Moving {direction} with expected value {val}")
-        print(f"Considered {agent.states_considered} states in {time.time() - start_time} seconds")
+        if self.cache is not None:
+            self.cache.reset_stats()
+        self.profiler.begin_move()
+        with self.profiler.span("search"):
+            val, direction = self.search(state)
+        stats = self.search_stats()
+        extra = dict(stats)
+        if self.cache is not None:
+            extra["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses,
+                              "evictions": self.cache.evictions}
+        self.profiler.end_move(nodes=self.states_considered, depth=self.depth_reached, **extra)
+        if self.verbose:
+            print(f"Moving {direction} with expected value {val}")
+            print(f"Considered {self.states_considered} states to depth {self.depth_reached} in {time.time() - start_time} seconds")
+            if self.cache is not None:
+                print(f"Cache: {self.cache}")
+            if "pruning_rate" in stats:
+                print(f"Pruned {stats['pruned']} of {stats['chance_children']} chance node "
+                      f"outcomes ({stats['pruning_rate']:.1%})")
         return direction
 
 
-set_time = 0
+class ExpectimaxAgent(Agent):
+    """Expectimax where chance nodes take the probability-weighted average over
+    every empty cell and the 2/4 spawn, rather than Agent's max.
+
+    Chance nodes reached with a cumulative probability below min_probability
+    are evaluated directly instead of expanded, and if max_spawn_cells is set
+    only that many empty cells are sampled at each chance node.
+
+    With pruning, moves are tried best first, by the previous iteration's
+    choice at the root and by their afterstate's value elsewhere, and chance
+    nodes are cut off Star1-style: once the outcomes searched so far plus the
+    most the rest could be worth can't beat the best move already found at
+    the parent, the rest are skipped. The most a state can be worth is
+    max_value if given, else its merges plus the most one move can merge
+    for each move left, and pruning needs max_value with an evaluator.
+    """
+    SPAWNS = [(2, .9), (4, .1)]
+
+    def __init__(self, max_depth=3, min_probability=0.0001, max_spawn_cells=None,
+                 cache_size=None, cache_replacement="lru", time_limit=None, evaluator=None,
+                 pruning=False, max_value=None):
+        super().__init__(max_depth, cache_size=cache_size, cache_replacement=cache_replacement,
+                         time_limit=time_limit, evaluator=evaluator)
+        self.min_probability = min_probability
+        self.max_spawn_cells = max_spawn_cells
+        if pruning and self.evaluator is not None and max_value is None:
+            raise ValueError("Pruning with an evaluator needs its max_value")
+        self.pruning = pruning
+        self.max_value = max_value
+        self.chance_children = 0
+        self.pruned_children = 0
+
+    def upper_bound(self, state, depth):
+        """Returns the most a state depth moves on from state can be worth"""
+        if self.max_value is not None:
+            return self.max_value
+        # A move merges at most size // 2 pairs in each of the size rows or columns
+        size = state.size
+        return state.merges + size * (size // 2) * depth
+
+    def expected_value(self, state, depth, probability=1.0, alpha=-float("inf")):
+        """Returns the value of the chance node after a move. With pruning, if
+        that can't be more than alpha an upper bound on it is returned instead"""
+        if probability < self.min_probability:
+            return self.value_state(state)
+        cells = list(state.empty_positions)
+        if self.max_spawn_cells and len(cells) > self.max_spawn_cells:
+            cells = random.sample(cells, self.max_spawn_cells)
+        cell_probability = probability / len(cells)
+        children = len(cells) * len(self.SPAWNS)
+        self.chance_children += children
+        upper = None
+        if self.pruning and alpha > -float("inf"):
+            upper = self.upper_bound(state, depth)
+        # total is the probability-weighted value so far, remaining the
+        # probability of the outcomes not searched yet
+        total = 0
+        remaining = 1.0
+        for y, x in cells:
+            for val, chance in self.SPAWNS:
+                p = chance / len(cells)
+                child_alpha = -float("inf")
+                if upper is not None:
+                    if total + remaining * upper <= alpha:
+                        self.pruned_children += children
+                        return total + remaining * upper
+                    # The least this outcome must be worth for the node to beat alpha
+                    child_alpha = (alpha - total - (remaining - p) * upper) / p
+                succ = self.clone(state)
+                succ.set_tile(y, x, val)
+                v, _ = self.find_best(succ, depth, cell_probability * chance, child_alpha)
+                self.release(succ)
+                total += p * v
+                remaining -= p
+                children -= 1
+        return total
+
+    def ordered_moves(self, state, first=None):
+        """Returns [(direction, next_state)] for the valid moves, first (if
+        valid) then the rest by their afterstate's value, highest first"""
+        moves = []
+        for direction in self.directions:
+            if state.can_move(direction):
+                next_state = state.transition(direction)
+                if direction == first:
+                    score = float("inf")
+                elif self.evaluator is not None:
+                    score = self.evaluator.evaluate(next_state.key())
+                else:
+                    score = next_state.merges
+                moves.append((score, direction, next_state))
+        moves.sort(key=lambda move: move[0], reverse=True)
+        return [(direction, next_state) for _, direction, next_state in moves]
+
+    def search(self, state):
+        self.chance_children = 0
+        self.pruned_children = 0
+        return super().search(state)
+
+    def search_stats(self):
+        if not self.pruning:
+            return {}
+        return {"chance_children": self.chance_children, "pruned": self.pruned_children,
+                "pruning_rate": self.pruned_children / max(self.chance_children, 1)}
+
+    def find_best(self, state, MAX_DEPTH=3, probability=1.0, alpha=-float("inf")):
+        self.check_deadline()
+        # Cached values are reused whatever probability they were searched with
+        use_cache = self.cache is not None and MAX_DEPTH > 0
+        if use_cache:
+            entry, key, symmetry = self.cache_lookup(state, MAX_DEPTH)
+            if entry is not None:
+                return entry
+        if MAX_DEPTH == 0 or not state.is_able_to_move():
+            return self.value_state(state), None
+        max_v = -float("inf")
+        best_dir = None
+        if self.pruning:
+            first = self.previous_best if probability == 1.0 else None
+            moves = self.ordered_moves(state, first)
+        else:
+            moves = ((d, state.transition(d)) for d in self.directions if state.can_move(d))
+        for direction, next_state in moves:
+            v = self.expected_value(next_state, MAX_DEPTH - 1, probability, max(alpha, max_v))
+            if v > max_v:
+                max_v = v
+                best_dir = direction
+        # A value no more than alpha may only be an upper bound
+        if use_cache and max_v > alpha:
+            self.cache_store(key, symmetry, MAX_DEPTH, max_v, best_dir)
+        return max_v, best_dir
+
+
+_rollout_agent = None
+
+def _init_rollout_worker(agent):
+    global _rollout_agent
+    _rollout_agent = agent
+
+def _run_rollouts(task):
+    """Returns (direction, total, count, nodes, elapsed_ns) for count rollouts from state"""
+    direction, state, count, seed = task
+    random.seed(seed)
+    _rollout_agent.states_considered = 0
+    start = perf_counter_ns()
+    total = _rollout_agent.rollout_total(state, count)
+    elapsed = perf_counter_ns() - start
+    return direction, total, count, _rollout_agent.states_considered, elapsed
+
+
 class MonteCarloAgent(Agent):
 
-    def __init__(self, max_depth=3, repetitions=10):
-        super().__init__()
+    def __init__(self, max_depth=3, repetitions=10, time_limit=None, workers=None, seed=None,
+                 evaluator=None):
+        super().__init__(time_limit=time_limit, evaluator=evaluator)
         self.mc_count = repetitions
         self.max_depth = max_depth
+        self.workers = workers
+        self.rng = random.Random(seed)
+        self._pool = None
+
+    def __getstate__(self):
+        # Workers get a copy of the agent that runs its rollouts serially
+        state = self.__dict__.copy()
+        state["workers"] = None
+        state["_pool"] = None
+        state["pools"] = {}
+        return state
+
+    def pool(self):
+        """Returns the process pool, starting it on first use so it is kept across moves"""
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_rollout_worker,
+                                              initargs=(self,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def parallel_totals(self, next_states, count):
+        """Splits count rollouts per direction across the worker pool and
+        returns the summed values for each direction. The workers' nodes and
+        rollouts are added to this agent's, and their time to a rollout phase"""
+        chunk, extra = divmod(count, self.workers)
+        tasks = []
+        for direction, next_state in next_states.items():
+            for i in range(self.workers):
+                n = chunk + (i < extra)
+                if n:
+                    tasks.append((direction, next_state, n, self.rng.getrandbits(32)))
+        totals = {d: 0 for d in next_states}
+        profiler = self.profiler
+        rollout_name = profiler.path("rollout")
+        for direction, total, n, nodes, elapsed in self.pool().imap_unordered(_run_rollouts, tasks):
+            totals[direction] += total
+            self.states_considered += nodes
+            profiler.count("rollouts", n)
+            if profiler.enabled:
+                profiler.add_time(rollout_name, elapsed)
+        return totals
 
     def _monte_carlo_iterative(self, state, depth=3):
-        root = Node(None,None,-1)
-        stack = deque([Node(state, parent=root, depth=0)])
-        while len(stack) > 0:
-            cur_node = stack.pop()
-            parent = cur_node.parent
+        size = state.size
+        bits = cell_bits(size)
+        moves = move_functions(size)
+        nodes = [Node(state.key(), state.merges, state.score, 0, -1, size)]
+        stack = [0]
+        # Reused to hand leaves to value_state without allocating a state each
+        leaf = BitboardState(size=size)
+        while stack:
+            index = stack.pop()
+            cur_node = nodes[index]
             if cur_node.depth == depth:
-                parent.best_child = max(parent.best_child, self.value_state(cur_node.state))
-            else:
-                for direction in self.directions:
-                    if cur_node.state.can_move(direction):
-                        next_state = cur_node.state.transition(direction)
-                        if not next_state.is_dead():
-                            next_state.add_random_tile()
-                            stack.append(Node(next_state, cur_node, cur_node.depth + 1))
-                        else:
-                            v = self.value_state(next_state)
-                            cur_node.best_child = max(cur_node.best_child, v)
-                if cur_node.best_child > parent.best_child:
-                    parent.best_child = cur_node.best_child
-        return root.best_child 
+                leaf.board, leaf.merges, leaf.score = cur_node.board, cur_node.merges, cur_node.score
+                self._propagate(nodes, index, self.value_state(leaf))
+                continue
+            for move in moves:
+                board, merges, _ = move(cur_node.board)
+                if board == cur_node.board:
+                    continue
+                next_node = Node(board, cur_node.merges + merges, cur_node.score,
+                                 cur_node.depth + 1, index, size)
+                if next_node.empty:
+                    cell = random.choice(mask_cells(next_node.empty, size))
+                    exponent, value = (2, 4) if random.random() < 0.1 else (1, 2)
+                    next_node.board |= exponent << (bits * cell)
+                    next_node.empty &= ~(1 << cell)
+                    next_node.score += value
+                    nodes.append(next_node)
+                    stack.append(len(nodes) - 1)
+                else:
+                    leaf.board, leaf.merges, leaf.score = board, next_node.merges, next_node.score
+                    self._propagate(nodes, index, self.value_state(leaf))
+        return nodes[0].best_child
+
+    def _propagate(self, nodes, index, value):
+        """Raises best_child along the path from nodes[index] to the root"""
+        while index >= 0 and nodes[index].best_child < value:
+            nodes[index].best_child = value
+            index = nodes[index].parent
 
     def _monte_carlo_helper(self, state, depth=5):
         if state.is_dead() or depth == 0:
             return self.value_state(state)
-        max_v = -1
+        max_v = -float("inf")
         for direction in self.directions:
             if state.can_move(direction):
                 next_state = state.transition(direction)
@@ -499,81 +730,150 @@ class MonteCarloAgent(Agent):
                     max_v = v
         return max_v
 
-    def monte_carlo(self, orig_state):
-        global set_time
+    def monte_carlo(self, orig_state, count=None):
+        count = count or self.mc_count
+        return self.rollout_total(orig_state, count) / count
+
+    def rollout_total(self, orig_state, count):
         total = 0
-        state = State(state=orig_state)
-        for i in range(self.mc_count):
-            v = self._monte_carlo_helper(state, self.max_depth)
-            # print("value;", v)
-            # print(state)
-            total += v
-            st_set = time.time()
-            state.set_from(orig_state)
-            set_time += time.time() - st_set
-        return total/self.mc_count
+        state = self.clone(orig_state)
+        with self.profiler.span("rollout"):
+            for i in range(count):
+                total += self._monte_carlo_helper(state, self.max_depth)
+                state.set_from(orig_state)
+        self.release(state)
+        self.profiler.count("rollouts", count)
+        return total
 
     def find_best(self, state):
         self.states_considered = 0
         value = self.value_state(state)
         if value == -float("inf"):
             return value, None
-        max_v = -1
-        best_dir = "LEFT"
-        dir_vals = {}
-        for direction in self.directions:
-            if state.can_move(direction):
-                next_state = state.transition(direction)
-                v = self.monte_carlo(next_state)
-                dir_vals[direction] = v
-                if v > max_v:
-                    max_v = v
-                    best_dir = direction
-        print(dir_vals)
+        # Evaluators can value every move below any fixed sentinel
+        max_v = -float("inf")
+        best_dir = None
+        if self.time_limit is None and self.workers:
+            next_states = {d: state.transition(d) for d in self.directions if state.can_move(d)}
+            with self.profiler.span("parallel"):
+                totals = self.parallel_totals(next_states, self.mc_count)
+            dir_vals = {d: total / self.mc_count for d, total in totals.items()}
+        elif self.time_limit is None:
+            dir_vals = {}
+            for direction in self.directions:
+                if state.can_move(direction):
+                    with self.profiler.span(direction):
+                        next_state = state.transition(direction)
+                        dir_vals[direction] = self.monte_carlo(next_state)
+        else:
+            dir_vals = self.monte_carlo_anytime(state)
+        for direction, v in dir_vals.items():
+            if v > max_v:
+                max_v = v
+                best_dir = direction
+        if self.verbose:
+            print(dir_vals)
         return max_v, best_dir
 
+    def monte_carlo_anytime(self, state):
+        """Adds one rollout per direction (one per worker with a pool) at a time
+        until time_limit runs out, returning the mean value for each direction"""
+        deadline = time.perf_counter() + self.time_limit
+        next_states = {d: state.transition(d) for d in self.directions if state.can_move(d)}
+        totals = {d: 0 for d in next_states}
+        count = 0
+        while next_states:
+            if self.workers:
+                for direction, total in self.parallel_totals(next_states, self.workers).items():
+                    totals[direction] += total
+                count += self.workers
+            else:
+                for direction, next_state in next_states.items():
+                    totals[direction] += self.rollout_total(next_state, 1)
+                count += 1
+            if time.perf_counter() > deadline:
+                break
+        self.depth_reached = count
+        return {d: total / count for d, total in totals.items()}
+
     def get_move(self, state):
+        self.check_evaluator(state)
         start_time = time.time()
+        self.profiler.begin_move()
         val, direction = self.find_best(state)
-        print(f"Considered {self.states_considered} states in {time.time() - start_time} seconds")
+        self.profiler.end_move(nodes=self.states_considered)
+        if self.verbose and self.time_limit is None:
+            print(f"Considered {self.states_considered} states in {time.time() - start_time} seconds")
+        elif self.verbose:
+            print(f"Ran {self.depth_reached} rollouts per direction in {time.time() - start_time} seconds")
         return direction
 
-dead_time = 0
-move_time = 0
-trans_time = 0
-rand_time = 0
-choice_time = 0
 class MonteCarloLight(MonteCarloAgent):
+
+    def __init__(self, max_depth=3, repetitions=10, time_limit=None, workers=None, seed=None,
+                 batch=False):
+        super().__init__(max_depth, repetitions, time_limit=time_limit, workers=workers, seed=seed)
+        self.batch = batch
+        self._batch_rollout = None
+
+    def rollout_total(self, orig_state, count):
+        # Batched rollouts only play 4x4 boards
+        if not self.batch or orig_state.size != 4:
+            return super().rollout_total(orig_state, count)
+        import numpy as np
+        if self._batch_rollout is None:
+            from batch_rollout import BatchRollout
+            self._batch_rollout = BatchRollout()
+        # Seeded from random so worker seeds still make the results reproducible
+        rng = np.random.default_rng(random.getrandbits(64))
+        with self.profiler.span("batch_rollout"):
+            scores, _, moves = self._batch_rollout.rollout(orig_state.key(), count,
+                                                           score=orig_state.score,
+                                                           merges=orig_state.merges, rng=rng)
+        self.states_considered += int(moves.sum())
+        self.profiler.count("rollouts", count)
+        return int(scores.sum())
     
     def _monte_carlo_helper(self, state, depth=5):
-        global dead_time, move_time, trans_time, rand_time, choice_time
-        st_dead = time.time()
-        dead = state.is_dead()
-        dead_time += time.time() - st_dead
+        if self.profiler.enabled:
+            return self._profiled_monte_carlo_helper(state)
+        steps = 0
         while state.is_able_to_move():
-            st_move = time.time()
+            state.transition_in_place(random.choice(list(state.valid_moves)))
+            steps += 1
+            if state.is_dead():
+                break
+            state.add_random_tile()
+        self.states_considered += steps
+        return state.score
+
+    def _profiled_monte_carlo_helper(self, state):
+        # Same as _monte_carlo_helper, timing each step of the playout
+        profiler = self.profiler
+        valid_moves_name = profiler.path("valid_moves")
+        transition_name = profiler.path("transition")
+        add_random_tile_name = profiler.path("add_random_tile")
+        steps = 0
+        while True:
+            start = perf_counter_ns()
+            able = state.is_able_to_move()
             valid_directions = list(state.valid_moves)
-            move_time += time.time() - st_move
+            profiler.add_time(valid_moves_name, perf_counter_ns() - start)
+            if not able:
+                break
 
-            st_choice = time.time()
-            direction = random.choice(valid_directions)
-            choice_time += time.time() - st_choice
+            start = perf_counter_ns()
+            state.transition_in_place(random.choice(valid_directions))
+            profiler.add_time(transition_name, perf_counter_ns() - start)
+            steps += 1
 
-            st_trans = time.time()
-            state.transition_in_place(direction)
-            trans_time += time.time() - st_trans
-            
             if state.is_dead():
                 break
 
-            st_rand = time.time()
+            start = perf_counter_ns()
             state.add_random_tile()
-            rand_time += time.time() - st_rand
-
-            # st_dead = time.time()
-            # dead = state.is_dead()
-            # dead_time += time.time() - st_dead
-
+            profiler.add_time(add_random_tile_name, perf_counter_ns() - start)
+        self.states_considered += steps
         return state.score
 
 
@@ -598,21 +898,14 @@ if __name__ == "__main__":
     agent = MonteCarloLight(repetitions=100)
     # agent = Agent(max_depth=5)
     # agent = RandomAgent()
+    agent.profiler.enabled = True
     while True:
         print(state)
        #  direction = input("\nMove> ").strip().upper()
        #  if direction == "AUTO" or direction == "A":
-        dead_time = 0
-        move_time = 0
-        trans_time = 0
-        rand_time = 0
-        set_time = 0
-        choice_time = 0
-        reset_times()
         direction = agent.get_move(state)
         state = state.transition(direction)
-        print(f"is_dead(): {dead_time}\ncan_move(): {move_time}\ntransition(): {trans_time}\nadd_random_tile(): {rand_time}\nset_from(): {set_time}\nRandom choice: {choice_time}")
-        print_times()
+        print(agent.profiler.format_report(agent.profiler.reports[-1]))
         print(f"Actual merges: {state.merges}")
         if state.is_dead():
             print("\n-----GAME OVER-----\n")
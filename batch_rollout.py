@@ -0,0 +1,109 @@
+import numpy as np
+
+from move_tables import get_tables
+
+
+U4 = np.uint64(4)
+U12 = np.uint64(12)
+U16 = np.uint64(16)
+U24 = np.uint64(24)
+U32 = np.uint64(32)
+U48 = np.uint64(48)
+ROW_MASK = np.uint64(0xFFFF)
+CELL_MASK = np.uint64(0xF)
+CELL_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+
+def transpose(boards):
+    a1 = boards & np.uint64(0xF0F00F0FF0F00F0F)
+    a2 = boards & np.uint64(0x0000F0F00000F0F0)
+    a3 = boards & np.uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << U12) | (a3 >> U12)
+    b1 = a & np.uint64(0xFF00FF0000FF00FF)
+    b2 = a & np.uint64(0x00FF00FF00000000)
+    b3 = a & np.uint64(0x00000000FF00FF00)
+    return b1 | (b2 >> U24) | (b3 << U24)
+
+
+class BatchRollout:
+    """Plays many random games at once on an array of packed 64-bit boards.
+
+    Uses the same packing and move tables as BitboardState, and the same
+    rules as MonteCarloLight: play random valid moves until no move is
+    possible or the board fills up, spawning a tile after every move.
+    """
+    def __init__(self, tables=None):
+        tables = tables or get_tables()
+        self.rows = [np.frombuffer(tables.left_rows, dtype=np.uint16).astype(np.uint64),
+                     np.frombuffer(tables.right_rows, dtype=np.uint16).astype(np.uint64)]
+        self.merges = [np.frombuffer(tables.left_merges, dtype=np.uint8).astype(np.int64),
+                       np.frombuffer(tables.right_merges, dtype=np.uint8).astype(np.int64)]
+
+    def _move_rows(self, boards, side):
+        rows = self.rows[side]
+        merges = self.merges[side]
+        r0 = (boards & ROW_MASK).astype(np.intp)
+        r1 = ((boards >> U16) & ROW_MASK).astype(np.intp)
+        r2 = ((boards >> U32) & ROW_MASK).astype(np.intp)
+        r3 = ((boards >> U48) & ROW_MASK).astype(np.intp)
+        return (rows[r0] | (rows[r1] << U16) | (rows[r2] << U32) | (rows[r3] << U48),
+                merges[r0] + merges[r1] + merges[r2] + merges[r3])
+
+    def moves(self, boards):
+        """Returns (4, N) arrays of the boards and merges after moving
+        LEFT, DOWN, RIGHT and UP"""
+        transposed = transpose(boards)
+        left, left_merges = self._move_rows(boards, 0)
+        right, right_merges = self._move_rows(boards, 1)
+        down, down_merges = self._move_rows(transposed, 0)
+        up, up_merges = self._move_rows(transposed, 1)
+        return (np.stack([left, transpose(down), right, transpose(up)]),
+                np.stack([left_merges, down_merges, right_merges, up_merges]))
+
+    @staticmethod
+    def empty_cells(boards):
+        return ((boards[:, None] >> CELL_SHIFTS) & CELL_MASK) == 0
+
+    @staticmethod
+    def add_random_tiles(boards, rng):
+        """Spawns a 2 (or a 4, one time in ten) on a random empty cell of every
+        board, which must all have one. Returns (new_boards, spawned_values)"""
+        weights = rng.random((len(boards), 16))
+        weights[~BatchRollout.empty_cells(boards)] = -1
+        cells = weights.argmax(axis=1).astype(np.uint64)
+        exponents = np.where(rng.random(len(boards)) < 0.1, 2, 1).astype(np.uint64)
+        return boards | (exponents << (cells * U4)), np.left_shift(1, exponents.astype(np.int64))
+
+    def rollout(self, board, count, score=0, merges=0, rng=None):
+        """Plays count random games from board, returning (scores, merges, moves)
+        arrays with the final score, merge count and moves played of each game"""
+        rng = rng if rng is not None else np.random.default_rng()
+        boards = np.full(count, board, dtype=np.uint64)
+        game_scores = np.full(count, score, dtype=np.int64)
+        game_merges = np.full(count, merges, dtype=np.int64)
+        game_moves = np.zeros(count, dtype=np.int64)
+        active = np.arange(count)
+        while len(active):
+            moved, moved_merges = self.moves(boards)
+            valid = moved != boards
+            able = valid.any(axis=0)
+            boards, moved, moved_merges, valid, active = (
+                boards[able], moved[:, able], moved_merges[:, able], valid[:, able], active[able])
+            if not len(active):
+                break
+
+            weights = rng.random(valid.shape)
+            weights[~valid] = -1
+            directions = weights.argmax(axis=0)
+            columns = np.arange(len(active))
+            boards = moved[directions, columns]
+            game_merges[active] += moved_merges[directions, columns]
+            game_moves[active] += 1
+
+            alive = self.empty_cells(boards).any(axis=1)
+            boards, active = boards[alive], active[alive]
+            if not len(active):
+                break
+            boards, spawned = self.add_random_tiles(boards, rng)
+            game_scores[active] += spawned
+        return game_scores, game_merges, game_moves
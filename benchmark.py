@@ -0,0 +1,310 @@
+"""Benchmarks the move engine and agents on fixed-seed board corpora.
+
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json
+    python benchmark.py --skip-agents --scaling 3,4,5,6,8
+
+Results are written as JSON (nanoseconds per operation). Against a
+baseline, any benchmark slower by more than --tolerance fails the run.
+--scaling also times moves and searches on midgame boards of each size,
+recording the nodes each search visited alongside.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from agent import Agent, ExpectimaxAgent, MonteCarloAgent, MonteCarloLight, RandomAgent, State
+from bitboard import MAX_SIZE, MIN_SIZE, BitboardState, check_size
+from mcts import MCTSAgent
+
+
+CORPUS_SIZE = 200
+
+# Boards are bucketed by how many empty cells they have
+CORPORA = {
+    "sparse": range(10, 15),
+    "midgame": range(5, 10),
+    "neardead": range(1, 3),
+}
+
+AGENTS = [
+    ("Agent", lambda: Agent(max_depth=2)),
+    ("ExpectimaxAgent", lambda: ExpectimaxAgent(max_depth=2)),
+    ("ExpectimaxAgent-pruning", lambda: ExpectimaxAgent(max_depth=2, pruning=True)),
+    ("MonteCarloAgent", lambda: MonteCarloAgent(max_depth=2, repetitions=5)),
+    ("MonteCarloLight", lambda: MonteCarloLight(repetitions=10)),
+    ("MonteCarloLight-batch", lambda: MonteCarloLight(repetitions=200, batch=True)),
+    ("MCTSAgent", lambda: MCTSAgent(iterations=100)),
+    ("RandomAgent", lambda: RandomAgent()),
+]
+
+# Only agents with bounded searches, as random games on 8x8 boards can run
+# to a million moves, which rules out rollouts to the end of the game
+SCALING_AGENTS = [
+    ("Agent", lambda: Agent(max_depth=2)),
+    ("ExpectimaxAgent", lambda: ExpectimaxAgent(max_depth=2)),
+    ("ExpectimaxAgent-pruning", lambda: ExpectimaxAgent(max_depth=2, pruning=True)),
+    ("MonteCarloAgent", lambda: MonteCarloAgent(max_depth=2, repetitions=5)),
+]
+
+
+def build_corpora(seed=0, size=CORPUS_SIZE):
+    """Plays seeded random games, collecting grids into each corpus until full"""
+    rng_state = random.getstate()
+    random.seed(seed)
+    corpora = {name: [] for name in CORPORA}
+    while any(len(grids) < size for grids in corpora.values()):
+        state = BitboardState([[0] * 4 for _ in range(4)])
+        state.add_random_tile()
+        state.add_random_tile()
+        while state.is_able_to_move():
+            empty = len(state.empty_positions)
+            for name, empties in CORPORA.items():
+                if empty in empties and len(corpora[name]) < size and random.random() < 0.2:
+                    corpora[name].append(state.grid)
+            state.transition_in_place(random.choice(sorted(state.valid_moves)))
+            if state.is_dead():
+                break
+            state.add_random_tile()
+    random.setstate(rng_state)
+    return corpora
+
+
+def midgame_boards(board_size, count, seed=0):
+    """Plays seeded random games on board_size x board_size boards, collecting
+    count grids with the share of empty cells of the midgame corpus"""
+    rng_state = random.getstate()
+    random.seed(seed)
+    cells = board_size * board_size
+    empties = range(round(cells * CORPORA["midgame"].start / 16),
+                    round(cells * CORPORA["midgame"].stop / 16))
+    grids = []
+    while len(grids) < count:
+        state = BitboardState([[0] * board_size for _ in range(board_size)])
+        state.add_random_tile()
+        state.add_random_tile()
+        while state.is_able_to_move() and len(grids) < count:
+            if len(state.empty_positions) in empties and random.random() < 0.2:
+                grids.append(state.grid)
+            state.transition_in_place(random.choice(sorted(state.valid_moves)))
+            if state.is_dead():
+                break
+            state.add_random_tile()
+    random.setstate(rng_state)
+    return grids
+
+
+def time_per_op(run, setup, ops, repeat):
+    """Returns the best nanoseconds per op over repeat runs of run(setup())"""
+    best = None
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter_ns()
+        run(arg)
+        elapsed = (time.perf_counter_ns() - start) / ops
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def engine_benchmarks(corpora, repeat):
+    results = {}
+    for corpus, grids in corpora.items():
+        for state_class in (State, BitboardState):
+            prefix = state_class.__name__
+            states = [state_class([row[:] for row in grid]) for grid in grids]
+            ops = len(states)
+
+            # BitboardState caches each move's result, so anything timing moves
+            # gets fresh copies every repeat
+            def copies():
+                return [state_class(state=s) for s in states]
+
+            def transition(states):
+                for s in states:
+                    for d in ("LEFT", "DOWN", "RIGHT", "UP"):
+                        s.transition(d)
+
+            def transition_in_place(states):
+                for s, d in zip(states, directions):
+                    s.transition_in_place(d)
+
+            def add_random_tile(states):
+                for s in states:
+                    s.add_random_tile()
+
+            def copy(states):
+                for s in states:
+                    state_class(state=s)
+
+            def valid_moves(states):
+                for s in states:
+                    s.valid_moves
+
+            random.seed(0)
+            directions = [random.choice(sorted(s.valid_moves)) for s in states]
+            results[f"{prefix}.transition/{corpus}"] = time_per_op(
+                transition, copies, 4 * ops, repeat)
+            results[f"{prefix}.transition_in_place/{corpus}"] = time_per_op(
+                transition_in_place, copies, ops, repeat)
+            results[f"{prefix}.add_random_tile/{corpus}"] = time_per_op(
+                add_random_tile, copies, ops, repeat)
+            results[f"{prefix}(state=...)/{corpus}"] = time_per_op(
+                copy, lambda: states, ops, repeat)
+            if state_class is State:
+                results[f"State._get_move_directions/{corpus}"] = time_per_op(
+                    lambda states: [s._get_move_directions() for s in states],
+                    lambda: states, ops, repeat)
+            else:
+                results[f"BitboardState.valid_moves/{corpus}"] = time_per_op(
+                    valid_moves, copies, ops, repeat)
+    return results
+
+
+def agent_benchmarks(corpora, boards):
+    results = {}
+    grids = corpora["midgame"][:boards]
+    for name, make_agent in AGENTS:
+        for state_class in (State, BitboardState):
+            agent = make_agent()
+            agent.verbose = False
+            random.seed(0)
+            states = [state_class([row[:] for row in grid]) for grid in grids]
+            start = time.perf_counter_ns()
+            for state in states:
+                agent.get_move(state)
+            results[f"{name}.get_move/{state_class.__name__}"] = \
+                (time.perf_counter_ns() - start) / len(states)
+    return results
+
+
+def scaling_benchmarks(sizes, boards, repeat):
+    """Returns (results, nodes) for each board size in sizes: the time per
+    move of each state class and per get_move of each SCALING_AGENTS agent,
+    and the mean nodes each agent's searches visited"""
+    results = {}
+    nodes = {}
+    for board_size in sizes:
+        prefix = f"scaling/{board_size}x{board_size}"
+        grids = midgame_boards(board_size, CORPUS_SIZE)
+        for state_class in (State, BitboardState):
+            def fresh_states():
+                return [state_class([row[:] for row in grid]) for grid in grids]
+
+            def transition(states):
+                for s in states:
+                    for d in ("LEFT", "DOWN", "RIGHT", "UP"):
+                        s.transition(d)
+
+            results[f"{prefix}/{state_class.__name__}.transition"] = time_per_op(
+                transition, fresh_states, 4 * len(grids), repeat)
+        for name, make_agent in SCALING_AGENTS:
+            agent = make_agent()
+            agent.verbose = False
+            random.seed(0)
+            states = [BitboardState([row[:] for row in grid]) for grid in grids[:boards]]
+            visited = 0
+            start = time.perf_counter_ns()
+            for state in states:
+                agent.get_move(state)
+                visited += agent.states_considered
+            results[f"{prefix}/{name}.get_move"] = (time.perf_counter_ns() - start) / len(states)
+            nodes[f"{prefix}/{name}.get_move"] = visited / len(states)
+    return results, nodes
+
+
+def print_scaling(results, nodes, sizes):
+    """Prints each scaling benchmark by board size, with its growth on the
+    next smaller size"""
+    names = sorted({name.split("/", 2)[2] for name in results if name.startswith("scaling/")})
+    print(f"{'':<40}" + "".join(f"{f'{n}x{n}':>16}" for n in sizes))
+    for name in names:
+        cells = []
+        previous = None
+        for n in sizes:
+            ns = results[f"scaling/{n}x{n}/{name}"]
+            growth = f" {ns / previous:4.1f}x" if previous else ""
+            cells.append(f"{ns / 1000:.1f}us{growth}")
+            previous = ns
+        print(f"{name:<40}" + "".join(f"{cell:>16}" for cell in cells))
+        if f"scaling/{sizes[0]}x{sizes[0]}/{name}" in nodes:
+            print(f"{'  nodes':<40}" + "".join(
+                f"{nodes[f'scaling/{n}x{n}/{name}']:>16.0f}" for n in sizes))
+
+
+def compare(results, baseline, tolerance):
+    """Prints each result against the baseline and returns the regressed names"""
+    regressions = []
+    for name, ns in results.items():
+        if name not in baseline:
+            print(f"{name:<50} {ns:>14.0f} ns  (new)")
+            continue
+        ratio = ns / baseline[name]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<50} {ns:>14.0f} ns  {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="also write the results here as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a benchmark counts as regressed")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--agent-boards", type=int, default=5,
+                        help="midgame boards to time each agent's get_move on")
+    parser.add_argument("--skip-agents", action="store_true")
+    parser.add_argument("--scaling", metavar="SIZES",
+                        help=f"comma separated board sizes, {MIN_SIZE} to {MAX_SIZE}, to time "
+                             "moves and searches on")
+    args = parser.parse_args()
+    sizes = []
+    if args.scaling:
+        sizes = sorted({int(n) for n in args.scaling.split(",")})
+        for n in sizes:
+            check_size(n)
+
+    corpora = build_corpora()
+    results = engine_benchmarks(corpora, args.repeat)
+    if not args.skip_agents:
+        results.update(agent_benchmarks(corpora, args.agent_boards))
+    nodes = {}
+    if sizes:
+        scaling, nodes = scaling_benchmarks(sizes, args.agent_boards, args.repeat)
+        results.update(scaling)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if nodes:
+        report["nodes"] = nodes
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if sizes:
+        print()
+        print_scaling(results, nodes, sizes)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import random
+
+from move_tables import MOVES, cell_bits, get_moves, get_tables
+
+
+DIRECTIONS = ["LEFT", "DOWN", "RIGHT", "UP"]
+MOVE_FUNCTIONS = [MOVES[d] for d in DIRECTIONS]
+
+MIN_SIZE = 3
+MAX_SIZE = 8
+
+CELL_MASK = 0xF
+
+
+VALUES = [1 << e if e else 0 for e in range(32)]
+EXPONENTS = {v: e for e, v in enumerate(VALUES)}
+
+
+def to_exponent(value):
+    return value.bit_length() - 1 if value else 0
+
+
+def to_value(exponent):
+    return 1 << exponent if exponent else 0
+
+
+def move_functions(size=4):
+    """MOVE_FUNCTIONS for size x size boards"""
+    moves = get_moves(size)
+    return [moves[d] for d in DIRECTIONS]
+
+
+def check_size(size):
+    if not MIN_SIZE <= size <= MAX_SIZE:
+        raise ValueError(f"Boards must be {MIN_SIZE}x{MIN_SIZE} to {MAX_SIZE}x{MAX_SIZE}, "
+                         f"not {size}x{size}")
+
+
+def pack(grid):
+    """Packs a 4x4 grid of tile values into a 64-bit int of 4-bit exponents.
+
+    Cell (r, c) lives at bits 4 * (4 * r + c), so row r is the 16-bit word
+    starting at bit 16 * r and column 0 is the low nibble of each row.
+    Other sizes pack the same way with move_tables.cell_bits(size) bits a
+    cell, cell (r, c) at bits cell_bits * (size * r + c).
+    """
+    board = 0
+    shift = 0
+    bits = cell_bits(len(grid))
+    for row in grid:
+        for x in row:
+            board |= EXPONENTS[x] << shift
+            shift += bits
+    return board
+
+
+def unpack(board, size=4):
+    if size != 4:
+        bits = cell_bits(size)
+        mask = (1 << bits) - 1
+        return [[VALUES[(board >> (bits * (size * r + c))) & mask] for c in range(size)]
+                for r in range(size)]
+    return [[VALUES[(board >> s) & CELL_MASK] for s in (r, r + 4, r + 8, r + 12)]
+            for r in (0, 16, 32, 48)]
+
+
+_left_values = {}
+_right_values = {}
+
+
+def _slide_values(line, cache, rows, merges):
+    key = tuple(line)
+    result = cache.get(key)
+    if result is None:
+        row = (EXPONENTS[key[0]] | (EXPONENTS[key[1]] << 4) |
+               (EXPONENTS[key[2]] << 8) | (EXPONENTS[key[3]] << 12))
+        new_row = rows[row]
+        result = cache[key] = ((VALUES[new_row & CELL_MASK], VALUES[(new_row >> 4) & CELL_MASK],
+                                VALUES[(new_row >> 8) & CELL_MASK], VALUES[new_row >> 12]),
+                               merges[row])
+    return result
+
+
+def move_grid(grid, direction):
+    """Returns (new_grid, merges) for a 4x4 grid of tile values.
+
+    This is move_tables.move for list-based boards; each row or column is
+    looked up in the same tables, keyed by its tuple of values. Other sizes
+    are packed and moved with move_tables.get_moves.
+    """
+    if len(grid) != 4:
+        size = len(grid)
+        try:
+            move = get_moves(size)[direction]
+        except KeyError:
+            raise ValueError(f"Unknown direction {direction}") from None
+        board, merges, _ = move(pack(grid))
+        return unpack(board, size), merges
+    tables = get_tables()
+    if direction == "LEFT" or direction == "DOWN":
+        cache, rows, merges = _left_values, tables.left_rows, tables.left_merges
+    elif direction == "RIGHT" or direction == "UP":
+        cache, rows, merges = _right_values, tables.right_rows, tables.right_merges
+    else:
+        raise ValueError(f"Unknown direction {direction}")
+    vertical = direction == "DOWN" or direction == "UP"
+    results = [_slide_values(line, cache, rows, merges)
+               for line in (zip(*grid) if vertical else grid)]
+    lines = [line for line, _ in results]
+    new_grid = [list(line) for line in (zip(*lines) if vertical else lines)]
+    return new_grid, sum([m for _, m in results])
+
+
+def line_cells(size, direction):
+    """Returns the (y, x) cells of each line a move in direction slides
+    tiles along, starting from the edge they slide towards"""
+    forward = list(range(size))
+    backward = forward[::-1]
+    if direction == "LEFT":
+        return [[(y, x) for x in forward] for y in forward]
+    if direction == "RIGHT":
+        return [[(y, x) for x in backward] for y in forward]
+    if direction == "DOWN":
+        return [[(y, x) for y in forward] for x in forward]
+    if direction == "UP":
+        return [[(y, x) for y in backward] for x in forward]
+    raise ValueError(f"Unknown direction {direction}")
+
+
+def tile_paths(old_grid, new_grid, direction):
+    """Diffs the grids before and after a move, returning [(from, to)] cells
+    for every tile that moved. Two tiles moving to the same cell merged there,
+    and within a line tiles are listed from the edge they slid towards.
+    """
+    paths = []
+    for line in line_cells(len(old_grid), direction):
+        old = [(cell, old_grid[cell[0]][cell[1]]) for cell in line if old_grid[cell[0]][cell[1]]]
+        i = 0
+        for to in line:
+            value = new_grid[to[0]][to[1]]
+            if not value:
+                break
+            cell, old_value = old[i]
+            paths.append((cell, to))
+            i += 1
+            if value != old_value:
+                # Made by merging this tile with the next one
+                paths.append((old[i][0], to))
+                i += 1
+    return [(cell, to) for cell, to in paths if cell != to]
+
+
+def empty_cells(board, size=4):
+    bits = cell_bits(size)
+    cell = (1 << bits) - 1
+    return [i for i in range(size * size) if not (board >> (bits * i)) & cell]
+
+
+def empty_mask(board, size=4):
+    """Returns a size * size bit mask with bit i set when cell i is empty"""
+    bits = cell_bits(size)
+    cell = (1 << bits) - 1
+    mask = 0
+    for i in range(size * size):
+        if not (board >> (bits * i)) & cell:
+            mask |= 1 << i
+    return mask
+
+
+def mask_cells(mask, size=4):
+    return [i for i in range(size * size) if (mask >> i) & 1]
+
+
+class BitboardState:
+    """A drop-in replacement for agent.State backed by a single int, 64 bits
+    for 4x4 boards and cell_bits(size) * size * size bits for the others"""
+    __slots__ = ("board", "merges", "score", "size", "_moves", "_move_functions")
+
+    def __init__(self, grid=None, merges=0, state=None, board=0, score=0, size=4):
+        self.board = board
+        self.merges = merges
+        self.score = score
+        self.size = size
+        self._moves = {}
+        if grid:
+            self.size = len(grid)
+            self.board = pack(grid)
+        if state is not None:
+            self.set_from(state)
+        if self.size != 4:
+            check_size(self.size)
+        self._move_functions = get_moves(self.size)
+
+    @classmethod
+    def from_board(cls, board, merges=0, score=0, size=4):
+        return cls(board=board, merges=merges, score=score, size=size)
+
+    def set_from(self, state):
+        self.board = state.board if isinstance(state, BitboardState) else pack(state.grid)
+        self.merges = state.merges
+        self.score = state.score
+        if state.size != self.size:
+            self.size = state.size
+            self._move_functions = get_moves(self.size)
+        self._moves.clear()
+
+    def key(self):
+        return self.board
+
+    @property
+    def grid(self):
+        return unpack(self.board, self.size)
+
+    @property
+    def empty_positions(self):
+        return {divmod(i, self.size) for i in empty_cells(self.board, self.size)}
+
+    @property
+    def valid_moves(self):
+        return {d for d in DIRECTIONS if self.can_move(d)}
+
+    def set_tile(self, y, x, value):
+        bits = cell_bits(self.size)
+        shift = bits * (self.size * y + x)
+        self.board = (self.board & ~(((1 << bits) - 1) << shift)) | (to_exponent(value) << shift)
+        self._moves.clear()
+
+    def _move(self, direction):
+        result = self._moves.get(direction)
+        if result is None:
+            result = self._moves[direction] = self._move_functions[direction](self.board)
+        return result
+
+    def add_random_tile(self):
+        y, x = divmod(random.choice(empty_cells(self.board, self.size)), self.size)
+        if random.random() < 0.1:
+            self.set_tile(y, x, 4)
+            self.score += 4
+        else:
+            self.set_tile(y, x, 2)
+            self.score += 2
+
+    def can_move(self, direction):
+        return self._move(direction)[0] != self.board
+
+    def transition_in_place(self, direction):
+        self.board, merges, _ = self._move(direction)
+        self.merges += merges
+        self._moves.clear()
+        return self
+
+    def transition(self, direction):
+        board, merges, _ = self._move(direction)
+        return BitboardState(board=board, merges=self.merges + merges, score=self.score,
+                             size=self.size)
+
+    def is_dead(self):
+        return not empty_cells(self.board, self.size)
+
+    def is_able_to_move(self):
+        for direction in DIRECTIONS:
+            if self.can_move(direction):
+                return True
+        return False
+
+    def __str__(self):
+        rows = []
+        for row in self.grid[::-1]:
+            rows.append(' '.join([str(x) for x in row]))
+        return '\n'.join(rows)
+
+    def full_stats(self):
+        return f"{'-' * 20}\n{str(self)}\nmerges: {self.merges}\ndirs: {self.valid_moves}\nempty: {self.empty_positions}\n{'-' * 20}"
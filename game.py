@@ -5,11 +5,18 @@ import time
 
 from grid import Grid, Tile
 from rect import Rect
-from agent import MonteCarloAgent, State
+from agent import MonteCarloAgent
+from bitboard import BitboardState, check_size, tile_paths
+from search_worker import SearchWorker
 
 
 class Player:
+    """Plays a game on a BitboardState, which is the authoritative board.
 
+    tiles holds the Tile drawn in each cell. It is only a view of the board:
+    after each move the old and new boards are diffed to work out which
+    tiles slide where, and which merge.
+    """
     def __init__(self, width, height, size, teleport=False):
         self.background = Grid(
             width,
@@ -19,165 +26,56 @@ class Player:
             background_color=(189,173,158),
             empty_color=(218,204,192)
         )
-        self.grid = [[None for _ in range(size)] for _ in range(size)]
+        self.state = BitboardState([[0 for _ in range(size)] for _ in range(size)])
+        self.tiles = [[None for _ in range(size)] for _ in range(size)]
         self.size = size
         self.direction = None
         self.moving = False
         self.speed = 2000.0
         self.teleport = teleport
+        # ((x, y), value) of the tile to spawn after the current move, if
+        # it was chosen up front
+        self.next_spawn = None
 
     def reset_grid(self):
-        for r in range(len(self.grid)):
-            for c in range(len(self.grid)):
-                self.grid[r][c] = None 
-
-    def add_random_tile(self):
-        # Find open positions
-        open_positions = []
-        for y in range(self.size):
-            for x in range(self.size):
-                if not self.grid[y][x]:
-                    open_positions.append((x,y))
-        pos = random.choice(open_positions)
-
-        # Create a new tile
-        tile = self.background.make_tile_at(pos[0],pos[1])
-
-        self.grid[pos[1]][pos[0]] = tile
-        self.print_grid()
-
-    def print_grid(self):
-        elems = []
-        for row in self.grid[::-1]:
-            for x in row:
-                elems.append(str(x.value) if x else '0')
-            elems.append('\n')
-        print(' '.join(elems))
-
-
-    def can_move(self, direction):
-        for x in range(self.size):
-            for y in range(self.size):
-                cur_tile = self.grid[y][x]
-                if cur_tile:
-                    if direction == "LEFT" and x > 0:
-                        adj = self.grid[y][x - 1]
-                        if (not adj or adj.value == cur_tile.value):
-                            return True
-                    if direction == "RIGHT" and x < self.size - 1:
-                        adj = self.grid[y][x + 1]
-                        if (not adj or adj.value == cur_tile.value):
-                            return True
-                    if direction == "DOWN" and y > 0:
-                        adj = self.grid[y - 1][x]
-                        if (not adj or adj.value == cur_tile.value):
-                            return True
-                    if direction == "UP" and y < self.size - 1:
-                        adj = self.grid[y + 1][x]
-                        if (not adj or adj.value == cur_tile.value):
-                            return True
-        return False
+        for tile in self.iter_tiles():
+            tile.delete()
+        self.tiles = [[None for _ in range(self.size)] for _ in range(self.size)]
+        self.state = BitboardState([[0 for _ in range(self.size)] for _ in range(self.size)])
+
+    def add_random_tile(self, pos=None, value=None):
+        if pos is None:
+            y, x = random.choice(sorted(self.state.empty_positions))
+            pos = (x, y)
+        if value is None:
+            value = 4 if random.random() < 0.1 else 2
+        self.state.set_tile(pos[1], pos[0], value)
+        self.state.score += value
+        self.tiles[pos[1]][pos[0]] = self.background.make_tile_at(pos[0], pos[1], value)
+        print(self.state, end="\n\n")
 
     def move_tile(self, x, y, to_x, to_y):
-        tile = self.grid[y][x]
-        self.grid[y][x] = None
-        dest_tile = self.grid[to_y][to_x]
+        tile = self.tiles[y][x]
+        self.tiles[y][x] = None
+        dest_tile = self.tiles[to_y][to_x]
         if dest_tile is not None:
             dest_tile.absorb(tile)
         else:
-            self.grid[to_y][to_x] = tile
+            self.tiles[to_y][to_x] = tile
         px, py = self.background.grid_pos_to_pixel_pos(to_x, to_y)
         tile.move_to(px, py, teleport=self.teleport)
 
-
     def transition(self, direction):
-        if self.moving or not self.can_move(direction):
+        if self.moving or not self.state.can_move(direction):
             return
+        old_grid = self.state.grid
+        self.state.transition_in_place(direction)
+        for (y, x), (to_y, to_x) in tile_paths(old_grid, self.state.grid, direction):
+            self.move_tile(x, y, to_x, to_y)
 
-        # Update grid representation
-        if direction == 'LEFT':
-            for y in range(self.size):
-                prev_idx = 0
-                for x in range(1, self.size):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[y][prev_idx] is None:
-                            self.move_tile(x, y, prev_idx, y)
-                        elif self.grid[y][prev_idx].value == cur_tile.value and prev_idx != x:
-                            # Check Merge
-                            self.move_tile(x, y, prev_idx, y)
-                            prev_idx += 1
-                        elif self.grid[y][prev_idx + 1] is None:
-                            # Move into adj
-                            self.move_tile(x, y, prev_idx + 1, y)
-                            prev_idx += 1
-                        else:
-                            prev_idx = x
-        elif direction == 'RIGHT':
-            for y in range(self.size):
-                prev_idx = self.size - 1
-                for x in range(self.size - 2, -1, -1):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[y][prev_idx] is None:
-                            self.move_tile(x, y, prev_idx, y)
-                        elif self.grid[y][prev_idx].value == cur_tile.value and prev_idx != x:
-                            # Check Merge
-                            self.move_tile(x, y, prev_idx, y)
-                            prev_idx -= 1
-                        elif self.grid[y][prev_idx - 1] is None:
-                            # Move into adj
-                            self.move_tile(x, y, prev_idx - 1, y)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = x
-        elif direction == 'DOWN':
-            for x in range(self.size):
-                prev_idx = 0
-                for y in range(1, self.size):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[prev_idx][x] is None:
-                            self.move_tile(x, y, x, prev_idx)
-                        elif self.grid[prev_idx][x].value == cur_tile.value and prev_idx != y:
-                            # Check Merge
-                            self.move_tile(x, y, x, prev_idx)
-                            prev_idx += 1
-                        elif self.grid[prev_idx + 1][x] is None:
-                            # Move into adj
-                            self.move_tile(x, y, x, prev_idx + 1)
-                            prev_idx += 1
-                        else:
-                            prev_idx = y
-        elif direction == 'UP':
-            for x in range(self.size):
-                prev_idx = self.size - 1
-                for y in range(self.size - 2, -1, -1):
-                    cur_tile = self.grid[y][x]
-                    if cur_tile:
-                        # Check if empty
-                        if self.grid[prev_idx][x] is None:
-                            self.move_tile(x, y, x, prev_idx)
-                        elif self.grid[prev_idx][x].value == cur_tile.value and prev_idx != y:
-                            # Check Merge
-                            self.move_tile(x, y, x, prev_idx)
-                            prev_idx -= 1
-                        elif self.grid[prev_idx - 1][x] is None:
-                            # Move into adj
-                            self.move_tile(x, y, x, prev_idx - 1)
-                            prev_idx -= 1
-                        else:
-                            prev_idx = y
-
-        self.print_grid()
-        
         # Start moving tiles
         self.direction = direction
         self.moving = True
-            
 
     def move(self, dt):
         if not self.moving:
@@ -189,10 +87,14 @@ class Player:
         self.moving = self.tiles_moving()
         if not self.moving:
             self.direction = None
-            self.add_random_tile()
+            if self.next_spawn is not None:
+                self.add_random_tile(*self.next_spawn)
+                self.next_spawn = None
+            else:
+                self.add_random_tile()
         
     def iter_tiles(self):
-        for row in self.grid:
+        for row in self.tiles:
             for tile in row:
                 if tile is not None:
                     yield tile
@@ -204,36 +106,80 @@ class Player:
         return False
 
     def draw(self):
+        # The tiles are in the background's batch
         self.background.draw()
 
-        for tile in self.iter_tiles():
-            tile.draw()
 
 
+# Returned by start_game's next_move while the worker hasn't found the move
+SEARCHING = object()
+
+
+def start_game(search="thread", size=4):
+    """Runs the game on a size x size board with an agent playing.
 
-def start_game():
+    search is "thread" or "process" to search in a SearchWorker, or None to
+    search inside update, which stops the window redrawing until it's done.
+    In the background the spawn after each move is chosen as the move is
+    made, so the position it leads to is searched while the tiles slide.
+    """
     width = 800
     height = 800
     fps = 60.0
     window = pyglet.window.Window(width, height)
 
-    player = Player(width, height, 4)
+    check_size(size)
+    player = Player(width, height, size)
     player.reset_grid()
     player.add_random_tile()
     player.add_random_tile()
     agent = MonteCarloAgent(max_depth=4, repetitions=30)
+    worker = SearchWorker(agent, process=search == "process") if search else None
     player.was_moving = False
+    # Counts positions, so moves searched for old ones can be told apart
+    player.turn = 0
+    player.searching = None
+
+    def next_move():
+        """Returns the agent's move for the current position, which is None if
+        it has none, or SEARCHING while the worker is still searching it"""
+        if worker is None:
+            return agent.get_move(player.state)
+        if player.searching != player.turn:
+            worker.submit(BitboardState(state=player.state), tag=player.turn)
+            player.searching = player.turn
+        result = worker.poll()
+        while result is not None and result[0] != player.turn:
+            result = worker.poll()
+        return SEARCHING if result is None else result[1]
+
+    def game_over():
+        print("GAME OVER")
+        exit()
 
     def update(dt):
         if not player.moving:
-            state = State()
-            state.from_tiles(player.grid)
-            direction = agent.get_move(state)
-            state.transition(direction)
-            if state.is_dead():
-                print("GAME OVER")
-                exit()
+            if not player.state.is_able_to_move():
+                game_over()
+            direction = next_move()
+            if direction is SEARCHING:
+                return
+            if direction is None:
+                game_over()
+            state = player.state.transition(direction)
             player.transition(direction)
+            if not player.moving:
+                # The move wasn't possible, so search the position again
+                player.searching = None
+                return
+            player.turn += 1
+            if worker is not None:
+                y, x = random.choice(sorted(state.empty_positions))
+                value = 4 if random.random() < 0.1 else 2
+                state.set_tile(y, x, value)
+                player.next_spawn = ((x, y), value)
+                worker.submit(state, tag=player.turn)
+                player.searching = player.turn
             player.was_moving = False
         else:
             if not player.was_moving:
@@ -250,6 +196,9 @@ def start_game():
 
     @window.event
     def on_key_press(symbol, modifiers):
+        # Any search in flight is for a position that is about to change
+        player.turn += 1
+        player.next_spawn = None
         if symbol == key.SPACE:
             player.reset_grid()
             player.add_random_tile()
@@ -269,5 +218,6 @@ def start_game():
 
 
 if __name__ == '__main__':
-    start_game()
+    import sys
+    start_game(size=int(sys.argv[1]) if len(sys.argv) > 1 else 4)
 
@@ -18,6 +18,37 @@ COLORS = {
     2048: (237,197,1),
     4096: (94,218,146)
 }
+# Tiles past the end of COLORS, which bigger boards reach, darken from here
+BEYOND_COLOR = (60, 58, 50)
+
+
+def tile_color(value):
+    color = COLORS.get(value)
+    if color is None:
+        # One shade darker for each doubling past 4096
+        steps = value.bit_length() - 13
+        color = tuple(max(0, c - 6 * steps) for c in BEYOND_COLOR)
+    return color
+
+
+def label_color(value):
+    """Black on the light tiles, white on the dark ones past COLORS"""
+    return (0, 0, 0, 255) if value in COLORS else (249, 246, 242, 255)
+
+
+# Drawing order within a Grid's batch. A tile being absorbed slides in
+# underneath the tile absorbing it.
+BACKGROUND_GROUP = pyglet.graphics.OrderedGroup(0)
+CELL_GROUP = pyglet.graphics.OrderedGroup(1)
+ABSORBED_TILE_GROUP = pyglet.graphics.OrderedGroup(2)
+ABSORBED_LABEL_GROUP = pyglet.graphics.OrderedGroup(3)
+TILE_GROUP = pyglet.graphics.OrderedGroup(4)
+LABEL_GROUP = pyglet.graphics.OrderedGroup(5)
+
+
+def font_size(value, width):
+    """The size that fits value's digits across a tile width wide"""
+    return math.floor(72/96 * (width / len(str(value)) *.95))
 
 
 def dist(x1, y1, x2, y2):
@@ -25,8 +56,12 @@ def dist(x1, y1, x2, y2):
 
 
 class Tile:
-    """A rectangle with a number"""
-    def __init__(self, x, y, width, height):
+    """A rectangle with a number
+
+    Its quad and label live in batch, or a batch of its own if none is given.
+    """
+    def __init__(self, x, y, width, height, batch=None, value=None):
+        self.batch = batch or pyglet.graphics.Batch()
         self.x = x
         self.y = y
         self.width = width
@@ -37,26 +72,32 @@ class Tile:
         self.to_x = self.x
         self.to_y = self.y
 
-        if ( random.random() < 0.1):
+        if value is not None:
+            self.value = value
+        elif ( random.random() < 0.1):
             self.value = 4
         else:
             self.value = 2
 
-        self.color = COLORS[self.value]
+        self.color = tile_color(self.value)
         self.child = None
-        self.font_size = math.floor(72/96 * (self.width / len(str(self.value)) *.95))
-
-        self.rect = Rect(self.x, self.y, self.width, self.height)
-        self.label = pyglet.text.Label(str(self.value),
-                                       font_name='Calibri',
-                                       font_size=self.font_size,
-                                       color=(0,0,0,255),
-                                       x=self.x + self.width // 2,
-                                       y=self.y + self.height // 2,
-                                       anchor_x='center',
-                                       anchor_y='center')
-
-        print(self.label.width)
+        self.font_size = font_size(self.value, self.width)
+
+        self.rect = Rect(self.x, self.y, self.width, self.height, color=self.color,
+                         batch=self.batch, group=TILE_GROUP)
+        self.label = self.make_label(LABEL_GROUP)
+
+    def make_label(self, group):
+        return pyglet.text.Label(str(self.value),
+                                 font_name='Calibri',
+                                 font_size=self.font_size,
+                                 color=label_color(self.value),
+                                 x=round(self.x + self.width // 2),
+                                 y=round(self.y + self.height // 2),
+                                 anchor_x='center',
+                                 anchor_y='center',
+                                 batch=self.batch,
+                                 group=group)
 
     def move_to(self, x, y, teleport=False):
         self.to_x = x
@@ -65,11 +106,20 @@ class Tile:
         self.teleport = teleport
 
     def draw(self):
+        """Draws just this tile, tiles are normally drawn with their whole batch"""
         if self.child is not None:
             self.child.draw()
-        self.rect.fill(self.color)
+        self.rect.vertex_list.draw(pyglet.gl.GL_QUADS)
         self.label.draw()
 
+    def delete(self):
+        """Removes the tile, and any tile it is absorbing, from its batch"""
+        if self.child is not None:
+            self.child.delete()
+            self.child = None
+        self.rect.delete()
+        self.label.delete()
+
     def move(self, speed):
         if self.moving:
             if self.child is not None:
@@ -85,6 +135,7 @@ class Tile:
                 if self.child is not None:
                     if not self.child.moving:
                         self.set(value=self.value + self.child.value)
+                        self.child.delete()
                         self.child = None
                         self.moving = False
                 else:
@@ -93,8 +144,13 @@ class Tile:
     def absorb(self, other):
         self.child = other
         self.moving = True
+        other.rect.migrate(other.batch, ABSORBED_TILE_GROUP)
+        # Labels can't change group, so this is the one time one is remade
+        other.label.delete()
+        other.label = other.make_label(ABSORBED_LABEL_GROUP)
 
     def set(self, x=None, y=None, width=None, height=None, value=None, color=None):
+        """Updates the tile, changing its quad and label in place"""
         if x is not None:
             self.x = x
             self.rect.x = x
@@ -107,28 +163,40 @@ class Tile:
         if height is not None:
             self.height = height
             self.rect.height = height
-        if value is not None:
-            self.value = value
-            self.label.text = str(self.value)
-            self.color = COLORS[value]
-            self.font_size = math.floor(72/96 * (self.width / len(str(self.value)) *.95))
         if color is not None:
             self.color = color
-        
-        self.label = pyglet.text.Label(str(self.value),
-                                       font_name='Calibri',
-                                       font_size=self.font_size,
-                                       color=(0,0,0,255),
-                                       x=self.x + self.width // 2,
-                                       y=self.y + self.height // 2,
-                                       anchor_x='center',
-                                       anchor_y='center')
+        self.rect.update()
+
+        # Moving a label shifts its vertices, while changing its text or size
+        # lays it out again, so that is only done when they change. Positions
+        # are kept whole so the shifted vertices don't drift from rounding.
+        label_x = round(self.x + self.width // 2)
+        label_y = round(self.y + self.height // 2)
+        if value is not None or width is not None:
+            if value is not None:
+                self.value = value
+                self.color = color or tile_color(value)
+            self.font_size = font_size(self.value, self.width)
+            self.label.begin_update()
+            self.label.text = str(self.value)
+            self.label.font_size = self.font_size
+            self.label.color = label_color(self.value)
+            self.label.x = label_x
+            self.label.y = label_y
+            self.label.end_update()
+        else:
+            self.label.x = label_x
+            self.label.y = label_y
+        self.rect.set_color(self.color)
 
 
 ######################################################################################################
 
 class Grid:
     """The background for the game
+
+    The background, the cells and every tile made by make_tile_at share one
+    batch, so draw() is a single batch draw.
     """
     def __init__(self, width, height, row_size, buffer_size, background_color, empty_color):
         self.width = width
@@ -140,27 +208,32 @@ class Grid:
         
         self.buffer_side_length = (self.width - self.buffer_size) // self.row_size
         self.side_length = self.buffer_side_length - self.buffer_size
+        self.batch = pyglet.graphics.Batch()
         self.cells = []
-        self.background = Rect(0, 0, self.width, self.height)
+        self.background = Rect(0, 0, self.width, self.height, color=self.background_color,
+                               batch=self.batch, group=BACKGROUND_GROUP)
         for i in range(self.row_size):
             for j in range(self.row_size):
                 self.cells.append(Rect(j * self.buffer_side_length + self.buffer_size,
                                i * self.buffer_side_length + self.buffer_size, 
                                self.side_length,
                                self.side_length,
+                               color=self.empty_color,
+                               batch=self.batch,
+                               group=CELL_GROUP,
                                ))
 
-    def make_tile_at(self, x, y):
+    def make_tile_at(self, x, y, value=None):
         return Tile(x * self.buffer_side_length + self.buffer_size,
                     y * self.buffer_side_length + self.buffer_size,
                     self.side_length,
-                    self.side_length)
+                    self.side_length,
+                    batch=self.batch,
+                    value=value)
 
     def grid_pos_to_pixel_pos(self, x, y):
         return (x * self.buffer_side_length + self.buffer_size,
                 y * self.buffer_side_length + self.buffer_size)
 
     def draw(self):
-        self.background.fill(self.background_color)
-        for cell in self.cells:
-            cell.fill(self.empty_color)
+        self.batch.draw()
@@ -0,0 +1,166 @@
+"""Hand-written board heuristics, evaluated over whole arrays of packed boards.
+
+Every feature but corner and density is a sum over the board's rows and
+columns, so each is precomputed for all 65536 packed rows and a board costs
+eight table lookups. evaluate() scores an array of boards in one NumPy call.
+HeuristicEvaluator wraps the same tables for scoring one board at a time,
+so it can be an Agent's evaluator.
+"""
+import numpy as np
+
+from batch_rollout import CELL_MASK, CELL_SHIFTS, transpose
+from move_tables import transpose as transpose_board
+
+
+ROW_COUNT = 1 << 16
+ROW_SHIFTS = np.array([0, 16, 32, 48], dtype=np.uint64)
+CORNER_SHIFTS = np.array([0, 12, 48, 60], dtype=np.uint64)
+
+DEFAULT_WEIGHTS = {
+    "monotonicity": 1.0,
+    "smoothness": 0.1,
+    "empty": 2.7,
+    "corner": 2.0,
+    "merges": 1.0,
+    "density": 0.0,
+}
+
+# Features that are a sum over rows and columns, and those over rows only
+LINE_FEATURES = ["monotonicity", "smoothness", "merges"]
+ROW_ONLY_FEATURES = ["empty"]
+
+
+def build_row_features():
+    """Returns {feature: array of its value for each packed row}.
+
+    Tile exponents are compared rather than values. monotonicity is minus the
+    smaller of the total rise and the total fall along the row, smoothness is
+    minus the total difference between neighbouring tiles and merges counts
+    neighbouring equal tiles, where empty cells don't separate neighbours.
+    tiles, total and max are the row's tile count, summed tile values and
+    largest exponent.
+    """
+    rows = np.arange(ROW_COUNT, dtype=np.int64)
+    cells = [(rows >> (4 * i)) & 0xF for i in range(4)]
+
+    rise = np.zeros(ROW_COUNT)
+    fall = np.zeros(ROW_COUNT)
+    for a, b in zip(cells, cells[1:]):
+        rise += np.maximum(b - a, 0)
+        fall += np.maximum(a - b, 0)
+
+    smoothness = np.zeros(ROW_COUNT)
+    merges = np.zeros(ROW_COUNT)
+    previous = np.zeros(ROW_COUNT, dtype=np.int64)
+    for cell in cells:
+        neighbours = (cell > 0) & (previous > 0)
+        smoothness -= np.where(neighbours, np.abs(cell - previous), 0)
+        merges += neighbours & (cell == previous)
+        previous = np.where(cell > 0, cell, previous)
+
+    tiles = sum((cell > 0).astype(np.int64) for cell in cells)
+    total = sum(np.where(cell > 0, 1 << cell, 0) for cell in cells)
+    return {
+        "monotonicity": -np.minimum(rise, fall),
+        "smoothness": smoothness,
+        "merges": merges,
+        "empty": 4 - tiles,
+        "tiles": tiles,
+        "total": total,
+        "max": np.maximum.reduce(cells),
+    }
+
+
+_row_features = None
+
+
+def get_row_features():
+    global _row_features
+    if _row_features is None:
+        _row_features = build_row_features()
+    return _row_features
+
+
+def _rows(boards):
+    return ((boards[:, None] >> ROW_SHIFTS) & np.uint64(0xFFFF)).astype(np.int64)
+
+
+def features(boards):
+    """Returns {feature: array of its value for each board} for an array of
+    packed boards, with a feature for every key of DEFAULT_WEIGHTS"""
+    boards = np.asarray(boards, dtype=np.uint64)
+    table = get_row_features()
+    rows = _rows(boards)
+    columns = _rows(transpose(boards))
+    result = {}
+    for name in LINE_FEATURES:
+        result[name] = table[name][rows].sum(axis=1) + table[name][columns].sum(axis=1)
+    for name in ROW_ONLY_FEATURES:
+        result[name] = table[name][rows].sum(axis=1)
+
+    tiles = table["tiles"][rows].sum(axis=1)
+    result["density"] = table["total"][rows].sum(axis=1) / np.maximum(tiles, 1)
+
+    exponents = (boards[:, None] >> CELL_SHIFTS) & CELL_MASK
+    corners = (boards[:, None] >> CORNER_SHIFTS) & CELL_MASK
+    max_exponent = exponents.max(axis=1)
+    # The largest tile's exponent if it is in a corner, else 0
+    result["corner"] = np.where((corners == max_exponent[:, None]).any(axis=1),
+                                max_exponent, 0).astype(np.float64)
+    return result
+
+
+def evaluate(boards, weights=DEFAULT_WEIGHTS):
+    """Returns the weighted sum of the features of each of an array of boards"""
+    values = features(boards)
+    total = np.zeros(len(values["empty"]))
+    for name, weight in weights.items():
+        if weight:
+            total += weight * values[name]
+    return total
+
+
+class HeuristicEvaluator:
+    """Scores single packed boards with the same features and weights as
+    evaluate(), for use as an Agent's evaluator.
+
+    The row and column features are folded into one table of weighted row
+    scores, so a board is eight lookups plus the corner and density terms.
+    """
+    def __init__(self, weights=DEFAULT_WEIGHTS):
+        self.weights = dict(weights)
+        table = get_row_features()
+        line = sum(self.weights.get(name, 0) * table[name] for name in LINE_FEATURES)
+        row = line + sum(self.weights.get(name, 0) * table[name] for name in ROW_ONLY_FEATURES)
+        self.row_scores = row.tolist()
+        self.column_scores = line.tolist()
+        self.tiles = table["tiles"].tolist()
+        self.totals = table["total"].tolist()
+        self.maxes = table["max"].tolist()
+        self.corner_weight = self.weights.get("corner", 0)
+        self.density_weight = self.weights.get("density", 0)
+
+    def evaluate(self, board):
+        r0 = board & 0xFFFF
+        r1 = (board >> 16) & 0xFFFF
+        r2 = (board >> 32) & 0xFFFF
+        r3 = board >> 48
+        t = transpose_board(board)
+        row_scores = self.row_scores
+        column_scores = self.column_scores
+        value = (row_scores[r0] + row_scores[r1] + row_scores[r2] + row_scores[r3] +
+                 column_scores[t & 0xFFFF] + column_scores[(t >> 16) & 0xFFFF] +
+                 column_scores[(t >> 32) & 0xFFFF] + column_scores[t >> 48])
+        if self.corner_weight:
+            maxes = self.maxes
+            max_exponent = max(maxes[r0], maxes[r1], maxes[r2], maxes[r3])
+            if max_exponent in (r0 & 0xF, r0 >> 12, r3 & 0xF, r3 >> 12):
+                value += self.corner_weight * max_exponent
+        if self.density_weight:
+            tiles = self.tiles[r0] + self.tiles[r1] + self.tiles[r2] + self.tiles[r3]
+            total = self.totals[r0] + self.totals[r1] + self.totals[r2] + self.totals[r3]
+            value += self.density_weight * total / max(tiles, 1)
+        return value
+
+    def evaluate_batch(self, boards):
+        return evaluate(boards, self.weights)
@@ -0,0 +1,179 @@
+import math
+import random
+import time
+
+from agent import Agent
+
+
+class DecisionNode:
+    """A position where the player picks a move, with one ChanceNode per move tried"""
+    __slots__ = ("state", "visits", "children", "untried")
+
+    def __init__(self, state, directions):
+        self.state = state
+        self.visits = 0
+        self.children = {}
+        self.untried = [d for d in directions if state.can_move(d)]
+
+
+class ChanceNode:
+    """The board after a move, before a tile spawns, with one DecisionNode per
+    spawn outcome sampled so far keyed by its board"""
+    __slots__ = ("state", "visits", "total", "children")
+
+    def __init__(self, state):
+        self.state = state
+        self.visits = 0
+        self.total = 0
+        self.children = {}
+
+
+class MCTSAgent(Agent):
+    """Monte Carlo Tree Search with UCT selection and explicit spawn chance nodes.
+
+    Each iteration walks down the tree picking moves by UCT and sampling
+    spawns, expands one new move, plays a rollout from there and backs the
+    final score up the path. rollout_policy is "random", like MonteCarloLight,
+    or "greedy", which plays the move whose afterstate value_state rates best,
+    by merges or by evaluator if one is given (see Agent).
+    The tree is kept between moves and re-rooted on the position actually
+    reached, so its statistics carry over.
+    """
+    def __init__(self, iterations=200, exploration=1.4, rollout_policy="random",
+                 time_limit=None, evaluator=None):
+        super().__init__(time_limit=time_limit, evaluator=evaluator)
+        if rollout_policy not in ("random", "greedy"):
+            raise ValueError(f"Unknown rollout policy {rollout_policy}")
+        self.iterations = iterations
+        self.exploration = exploration
+        self.rollout_policy = rollout_policy
+        self.root = None
+        self.last_direction = None
+        self.reused_visits = 0
+
+    def reroot(self, state):
+        """Moves the root onto state if the last search already reached it"""
+        key = state.key()
+        if self.root is not None and self.last_direction in self.root.children:
+            child = self.root.children[self.last_direction].children.get(key)
+            if child is not None:
+                self.root = child
+                self.reused_visits = child.visits
+                return
+        self.root = DecisionNode(self.clone(state), self.directions)
+        self.reused_visits = 0
+
+    def select_move(self, node):
+        # Mean rewards are scaled to [0, 1] over the node's children, so UCT
+        # weighs what the moves gain rather than the score already banked
+        log_visits = math.log(node.visits)
+        means = {d: child.total / child.visits for d, child in node.children.items()}
+        low = min(means.values())
+        spread = max(means.values()) - low or 1
+        best_value = -float("inf")
+        best_dir = None
+        for direction, child in node.children.items():
+            value = ((means[direction] - low) / spread +
+                     self.exploration * math.sqrt(log_visits / child.visits))
+            if value > best_value:
+                best_value = value
+                best_dir = direction
+        return best_dir
+
+    def iterate(self):
+        node = self.root
+        path = []
+        while True:
+            if node.untried:
+                direction = node.untried.pop(random.randrange(len(node.untried)))
+                chance = node.children[direction] = ChanceNode(node.state.transition(direction))
+            elif node.children:
+                chance = node.children[self.select_move(node)]
+            else:
+                # No moves left, so the game ends here
+                reward = node.state.score
+                break
+            path.append((node, chance))
+
+            state = self.clone(chance.state)
+            if state.is_dead():
+                reward = state.score
+                self.release(state)
+                break
+            state.add_random_tile()
+            key = state.key()
+            child = chance.children.get(key)
+            if child is None:
+                chance.children[key] = DecisionNode(state, self.directions)
+                reward = self.rollout(state)
+                break
+            self.release(state)
+            node = child
+
+        for decision, chance in path:
+            decision.visits += 1
+            chance.visits += 1
+            chance.total += reward
+
+    def rollout(self, orig_state):
+        state = self.clone(orig_state)
+        while state.is_able_to_move():
+            valid_directions = [d for d in self.directions if state.can_move(d)]
+            if self.rollout_policy == "random":
+                direction = random.choice(valid_directions)
+            else:
+                direction = self.greedy_move(state, valid_directions)
+            state.transition_in_place(direction)
+            self.states_considered += 1
+            if state.is_dead():
+                break
+            state.add_random_tile()
+        score = state.score
+        self.release(state)
+        return score
+
+    def greedy_move(self, state, valid_directions):
+        best_value = -float("inf")
+        best_dirs = []
+        for direction in valid_directions:
+            next_state = state.transition(direction)
+            value = self.value_state(next_state)
+            if value > best_value:
+                best_value = value
+                best_dirs = [direction]
+            elif value == best_value:
+                best_dirs.append(direction)
+        return random.choice(best_dirs)
+
+    def search(self, state):
+        self.reroot(state)
+        if self.time_limit is None:
+            for _ in range(self.iterations):
+                self.iterate()
+        else:
+            # At least one iteration, so a fresh tree has a move to return
+            deadline = time.perf_counter() + self.time_limit
+            self.iterate()
+            while time.perf_counter() < deadline:
+                self.iterate()
+        if not self.root.children:
+            return None, None
+        direction = max(self.root.children, key=lambda d: self.root.children[d].visits)
+        child = self.root.children[direction]
+        self.last_direction = direction
+        return child.total / child.visits, direction
+
+    def get_move(self, state):
+        self.check_evaluator(state)
+        start_time = time.time()
+        self.states_considered = 0
+        self.profiler.begin_move()
+        with self.profiler.span("search"):
+            val, direction = self.search(state)
+        self.profiler.end_move(nodes=self.states_considered, reused_visits=self.reused_visits)
+        if self.verbose:
+            print(f"Moving {direction} with expected value {val}")
+            print(f"Root has {self.root.visits} playouts ({self.reused_visits} reused), "
+                  f"{self.states_considered} rollout moves "
+                  f"in {time.time() - start_time} seconds")
+        return direction
@@ -0,0 +1,296 @@
+import os
+from array import array
+
+from tables import open_tables, write_tables
+
+
+ROW_MASK = 0xFFFF
+CELL_MASK = 0xF
+ROW_COUNT = 1 << 16
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "move_tables.bin")
+
+
+def cell_bits(size):
+    """Bits per cell on size x size boards. Up to 4x4 cells are nibbles, which
+    hold exponents up to 15; bigger boards outgrow 32768 tiles, so they get
+    5 bits and exponents up to 31."""
+    return 4 if size <= 4 else 5
+
+
+def reverse_row(row, size=4):
+    if size != 4:
+        bits = cell_bits(size)
+        mask = (1 << bits) - 1
+        return sum(((row >> (bits * i)) & mask) << (bits * (size - 1 - i)) for i in range(size))
+    return (((row & 0xF) << 12) | ((row & 0xF0) << 4) |
+            ((row >> 4) & 0xF0) | ((row >> 12) & 0xF))
+
+
+def transpose(board):
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+def slide_row(row, size=4):
+    """Slides a packed row of size cells towards column 0, returning
+    (new_row, merges, score)
+
+    score is the sum of the tiles created by merging.
+    """
+    bits = cell_bits(size)
+    mask = (1 << bits) - 1
+    tiles = []
+    for i in range(size):
+        x = (row >> (bits * i)) & mask
+        if x:
+            tiles.append(x)
+    merged = []
+    merges = 0
+    score = 0
+    i = 0
+    while i < len(tiles):
+        # mask is the largest exponent a cell can hold, so those never merge
+        if i + 1 < len(tiles) and tiles[i] == tiles[i + 1] and tiles[i] < mask:
+            merged.append(tiles[i] + 1)
+            merges += 1
+            score += 1 << (tiles[i] + 1)
+            i += 2
+        else:
+            merged.append(tiles[i])
+            i += 1
+    new_row = 0
+    for i, x in enumerate(merged):
+        new_row |= x << (bits * i)
+    return new_row, merges, score
+
+
+class MoveTables:
+    """Result row, merge count and score delta for every packed row"""
+    def __init__(self, left_rows, left_merges, left_scores,
+                 right_rows, right_merges, right_scores):
+        self.left_rows = left_rows
+        self.left_merges = left_merges
+        self.left_scores = left_scores
+        self.right_rows = right_rows
+        self.right_merges = right_merges
+        self.right_scores = right_scores
+
+    NAMES = ["left_rows", "left_merges", "left_scores",
+             "right_rows", "right_merges", "right_scores"]
+
+    def arrays(self):
+        return (self.left_rows, self.left_merges, self.left_scores,
+                self.right_rows, self.right_merges, self.right_scores)
+
+    @classmethod
+    def build(cls):
+        left_rows = array('H', bytes(2 * ROW_COUNT))
+        left_merges = array('B', bytes(ROW_COUNT))
+        left_scores = array('I', bytes(4 * ROW_COUNT))
+        right_rows = array('H', bytes(2 * ROW_COUNT))
+        right_merges = array('B', bytes(ROW_COUNT))
+        right_scores = array('I', bytes(4 * ROW_COUNT))
+        for row in range(ROW_COUNT):
+            new_row, merges, score = slide_row(row)
+            left_rows[row] = new_row
+            left_merges[row] = merges
+            left_scores[row] = score
+
+            rev = reverse_row(row)
+            right_rows[rev] = reverse_row(new_row)
+            right_merges[rev] = merges
+            right_scores[rev] = score
+        return cls(left_rows, left_merges, left_scores,
+                   right_rows, right_merges, right_scores)
+
+    @classmethod
+    def load(cls, path):
+        """Maps the tables saved at path read-only, see tables.open_tables"""
+        tables = open_tables(path, "move")
+        try:
+            arrays = [tables[name] for name in cls.NAMES]
+        except KeyError as e:
+            raise ValueError(f"{path} has no {e} table") from None
+        if any(len(a) != ROW_COUNT for a in arrays):
+            raise ValueError(f"{path} has tables of the wrong size")
+        return cls(*arrays)
+
+    def save(self, path):
+        write_tables(path, "move", list(zip(self.NAMES, self.arrays())))
+
+
+_tables = None
+
+
+def get_tables(path=TABLE_PATH):
+    """Returns the move tables, loading them from disk or building them once"""
+    global _tables
+    if _tables is None:
+        try:
+            _tables = MoveTables.load(path)
+        except (OSError, EOFError, ValueError):
+            _tables = MoveTables.build()
+            try:
+                _tables.save(path)
+            except OSError:
+                pass
+    return _tables
+
+
+def _move_rows(board, rows, merges, scores):
+    r0 = board & ROW_MASK
+    r1 = (board >> 16) & ROW_MASK
+    r2 = (board >> 32) & ROW_MASK
+    r3 = (board >> 48) & ROW_MASK
+    return (rows[r0] | (rows[r1] << 16) | (rows[r2] << 32) | (rows[r3] << 48),
+            merges[r0] + merges[r1] + merges[r2] + merges[r3],
+            scores[r0] + scores[r1] + scores[r2] + scores[r3])
+
+
+def move_left(board):
+    t = _tables or get_tables()
+    return _move_rows(board, t.left_rows, t.left_merges, t.left_scores)
+
+
+def move_right(board):
+    t = _tables or get_tables()
+    return _move_rows(board, t.right_rows, t.right_merges, t.right_scores)
+
+
+def move_down(board):
+    t = _tables or get_tables()
+    new_board, merges, score = _move_rows(transpose(board), t.left_rows, t.left_merges, t.left_scores)
+    return transpose(new_board), merges, score
+
+
+def move_up(board):
+    t = _tables or get_tables()
+    new_board, merges, score = _move_rows(transpose(board), t.right_rows, t.right_merges, t.right_scores)
+    return transpose(new_board), merges, score
+
+
+MOVES = {
+    "LEFT": move_left,
+    "DOWN": move_down,
+    "RIGHT": move_right,
+    "UP": move_up,
+}
+
+
+class SizedMoves:
+    """Moves for size x size boards packed like the 4x4 ones, but with
+    cell_bits(size) bits a cell: cell (r, c) is at bits
+    cell_bits * (size * r + c). Python ints grow as needed, so an 8x8 board
+    is still one int, just 320 bits of it.
+
+    A table of size n rows would need 2 ** (cell_bits * n) entries, so each row is
+    slid the first time it is seen and the result memoized. Big boards see
+    far more distinct rows than fit in memory, so each memo is emptied once
+    it holds MEMO_SIZE rows.
+    """
+    MEMO_SIZE = ROW_COUNT
+
+    def __init__(self, size):
+        self.size = size
+        self.cell_bits = cell_bits(size)
+        self.cell_mask = (1 << self.cell_bits) - 1
+        self.row_bits = self.cell_bits * size
+        self.row_mask = (1 << self.row_bits) - 1
+        self._left = {}
+        self._right = {}
+        # Each row's cells spread out to where transpose puts them
+        self._columns = {}
+        self.moves = {
+            "LEFT": self.move_left,
+            "DOWN": self.move_down,
+            "RIGHT": self.move_right,
+            "UP": self.move_up,
+        }
+
+    def _slide_left(self, row):
+        result = self._left.get(row)
+        if result is None:
+            if len(self._left) >= self.MEMO_SIZE:
+                self._left.clear()
+            result = self._left[row] = slide_row(row, self.size)
+        return result
+
+    def _slide_right(self, row):
+        result = self._right.get(row)
+        if result is None:
+            if len(self._right) >= self.MEMO_SIZE:
+                self._right.clear()
+            new_row, merges, score = slide_row(reverse_row(row, self.size), self.size)
+            result = self._right[row] = reverse_row(new_row, self.size), merges, score
+        return result
+
+    def _move_rows(self, board, slide):
+        new_board = merges = score = 0
+        for shift in range(0, self.row_bits * self.size, self.row_bits):
+            new_row, row_merges, row_score = slide((board >> shift) & self.row_mask)
+            new_board |= new_row << shift
+            merges += row_merges
+            score += row_score
+        return new_board, merges, score
+
+    def transpose(self, board):
+        result = 0
+        for r in range(self.size):
+            row = (board >> (self.row_bits * r)) & self.row_mask
+            column = self._columns.get(row)
+            if column is None:
+                if len(self._columns) >= self.MEMO_SIZE:
+                    self._columns.clear()
+                column = self._columns[row] = sum(
+                    ((row >> (self.cell_bits * c)) & self.cell_mask) << (self.row_bits * c)
+                    for c in range(self.size))
+            result |= column << (self.cell_bits * r)
+        return result
+
+    def move_left(self, board):
+        return self._move_rows(board, self._slide_left)
+
+    def move_right(self, board):
+        return self._move_rows(board, self._slide_right)
+
+    def move_down(self, board):
+        new_board, merges, score = self._move_rows(self.transpose(board), self._slide_left)
+        return self.transpose(new_board), merges, score
+
+    def move_up(self, board):
+        new_board, merges, score = self._move_rows(self.transpose(board), self._slide_right)
+        return self.transpose(new_board), merges, score
+
+
+_sized_moves = {}
+
+
+def sized_moves(size):
+    """Returns the shared SizedMoves for size x size boards"""
+    moves = _sized_moves.get(size)
+    if moves is None:
+        moves = _sized_moves[size] = SizedMoves(size)
+    return moves
+
+
+def get_moves(size=4):
+    """Returns {direction: move function} for size x size boards, the table
+    driven ones for 4x4"""
+    if size == 4:
+        return MOVES
+    return sized_moves(size).moves
+
+
+def move(board, direction):
+    """Returns (new_board, merges, score) after sliding the board in a direction"""
+    try:
+        return MOVES[direction](board)
+    except KeyError:
+        raise ValueError(f"Unknown direction {direction}") from None
@@ -0,0 +1,139 @@
+from array import array
+
+from symmetry import all_symmetries
+from tables import open_tables, write_tables
+
+
+# Cells are numbered 4 * row + column, matching the packed board's nibbles
+
+# Every row and every 2x2 square, folded down by symmetry to the distinct ones:
+# an outer row, an inner row, a corner square, an edge square and the centre
+TUPLES_4 = [
+    (0, 1, 2, 3),
+    (4, 5, 6, 7),
+    (0, 1, 4, 5),
+    (1, 2, 5, 6),
+    (5, 6, 9, 10),
+]
+
+# The 6-tuples of Szubert and Jaskowski, stronger but 16M weights per tuple
+TUPLES_6 = [
+    (0, 1, 2, 3, 4, 5),
+    (4, 5, 6, 7, 8, 9),
+    (0, 1, 2, 4, 5, 6),
+    (4, 5, 6, 8, 9, 10),
+]
+
+
+def tuple_runs(cells):
+    """Splits a tuple into runs of cells that sit next to each other in the
+    packed board, returning (shift, mask, out_shift) for each run so the tuple's
+    index is the sum of ((board >> shift) & mask) << out_shift
+    """
+    runs = []
+    start = 0
+    for i in range(1, len(cells) + 1):
+        if i == len(cells) or cells[i] != cells[i - 1] + 1:
+            length = i - start
+            runs.append((4 * cells[start], (1 << (4 * length)) - 1, 4 * start))
+            start = i
+    return runs
+
+
+def _compile_evaluate(runs, tables):
+    """Builds evaluate(board) with every tuple's index expression written out,
+    which is about twice as fast as looping over the runs per lookup
+    """
+    terms = []
+    for i, tuple_runs in enumerate(runs):
+        index = " | ".join(f"(((s >> {shift}) & {mask}) << {out_shift})"
+                           for shift, mask, out_shift in tuple_runs)
+        terms.append(f"tables[{i}][{index}]")
+    source = (
+        "def evaluate(board):\n"
+        "    total = 0.0\n"
+        "    for s in all_symmetries(board):\n"
+        f"        total += {' + '.join(terms)}\n"
+        "    return total\n"
+    )
+    namespace = {"all_symmetries": all_symmetries, "tables": tables}
+    exec(source, namespace)
+    return namespace["evaluate"]
+
+
+class NTupleNetwork:
+    """A value function made of one weight table per tuple of cells.
+
+    A tuple's table is indexed by the tile exponents along its cells packed
+    into one integer, and a board is worth the sum of every tuple's weight
+    over all 8 of its symmetries, which all share the same tables. So one
+    evaluation is 8 * len(tuples) index computations and array lookups.
+    """
+    def __init__(self, tuples=TUPLES_4, weights=None, path=None):
+        self.path = path
+        self.tuples = [tuple(cells) for cells in tuples]
+        self.runs = [tuple_runs(cells) for cells in self.tuples]
+        if weights is None:
+            weights = [array('f', bytes(4 * 16 ** len(cells))) for cells in self.tuples]
+        self.weights = weights
+        self.evaluate = _compile_evaluate(self.runs, self.weights)
+
+    def indices(self, board):
+        """Returns [(table, index)] for every tuple over every symmetry of board"""
+        result = []
+        for sym in all_symmetries(board):
+            for table, runs in zip(self.weights, self.runs):
+                index = 0
+                for shift, mask, out_shift in runs:
+                    index |= ((sym >> shift) & mask) << out_shift
+                result.append((table, index))
+        return result
+
+    def __getstate__(self):
+        # The compiled evaluate can't be pickled, so it is rebuilt on arrival.
+        # Mapped weights are sent as their path and mapped again.
+        if self.path is not None:
+            return {"path": self.path}
+        return {"tuples": self.tuples, "weights": self.weights}
+
+    def __setstate__(self, state):
+        if "path" in state:
+            self.__dict__.update(NTupleNetwork.load(state["path"]).__dict__)
+        else:
+            self.__init__(state["tuples"], state["weights"])
+
+    def update(self, board, delta):
+        """Adds delta, split evenly between them, to every weight board uses"""
+        indices = self.indices(board)
+        delta /= len(indices)
+        for table, index in indices:
+            table[index] += delta
+
+    @classmethod
+    def load(cls, path, writable=False):
+        """Loads weights saved by save(), along with their tuples.
+
+        Unless writable is set the weights are mapped read-only rather than
+        read, see tables.open_tables, so loading is instant and processes
+        using the same file share its memory. update() needs writable.
+        """
+        tables = open_tables(path, "ntuple")
+        tuples = []
+        weights = []
+        while f"tuple{len(tuples)}" in tables:
+            cells = tuple(tables[f"tuple{len(tuples)}"])
+            table = tables.get(f"weights{len(tuples)}")
+            if table is None or len(table) != 16 ** len(cells):
+                raise ValueError(f"{path} has no weights for tuple {cells}")
+            if writable:
+                table = array('f', table.tobytes())
+            tuples.append(cells)
+            weights.append(table)
+        return cls(tuples, weights, path=None if writable else path)
+
+    def save(self, path):
+        tables = []
+        for i, (cells, table) in enumerate(zip(self.tuples, self.weights)):
+            tables.append((f"tuple{i}", array('B', cells)))
+            tables.append((f"weights{i}", table))
+        write_tables(path, "ntuple", tables)
@@ -0,0 +1,111 @@
+import json
+from time import perf_counter_ns
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._stack.append(self.profiler.path(self.name))
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter_ns() - self.start
+        self.profiler.add_time(self.profiler._stack.pop(), elapsed)
+        return False
+
+
+class Profiler:
+    """Counters, timers and nestable spans for one agent, grouped into per-move reports.
+
+    Everything is a no-op while enabled is False, and the hottest loops check
+    enabled once up front rather than calling in here per step. Span names
+    nest, so a "rollout" span opened inside "LEFT" is reported as "LEFT/rollout".
+    If output is set each move's report is appended to it as a JSON line.
+    """
+    def __init__(self, enabled=False, output=None):
+        self.enabled = enabled
+        self.output = output
+        self.counters = {}
+        self.timings = {}
+        self.reports = []
+        self._stack = []
+        self._move_start = None
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, elapsed_ns):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [elapsed_ns, 1]
+        else:
+            timing[0] += elapsed_ns
+            timing[1] += 1
+
+    def path(self, name):
+        """Returns name nested under the innermost open span"""
+        return f"{self._stack[-1]}/{name}" if self._stack else name
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def begin_move(self):
+        if self.enabled:
+            self.counters = {}
+            self.timings = {}
+            self._stack = []
+            self._move_start = perf_counter_ns()
+
+    def end_move(self, nodes=0, **extra):
+        """Closes the current move's report, returning it (or None if disabled)"""
+        if not self.enabled or self._move_start is None:
+            return None
+        elapsed = perf_counter_ns() - self._move_start
+        self._move_start = None
+        report = {
+            "move": len(self.reports),
+            "time_ns": elapsed,
+            "nodes": nodes,
+            "nodes_per_sec": nodes / elapsed * 1e9 if elapsed else 0.0,
+            "phases": {name: {"time_ns": total, "calls": calls}
+                       for name, (total, calls) in self.timings.items()},
+            "counters": dict(self.counters),
+        }
+        report.update(extra)
+        self.reports.append(report)
+        if self.output is not None:
+            with open(self.output, "a") as f:
+                f.write(json.dumps(report) + "\n")
+        return report
+
+    def write_jsonl(self, path):
+        with open(path, "w") as f:
+            for report in self.reports:
+                f.write(json.dumps(report) + "\n")
+
+    def format_report(self, report):
+        lines = [f"move {report['move']}: {report['time_ns'] / 1e6:.2f}ms, "
+                 f"{report['nodes']} nodes ({report['nodes_per_sec']:.0f}/sec)"]
+        for name, phase in sorted(report["phases"].items()):
+            lines.append(f"  {name}: {phase['time_ns'] / 1e6:.2f}ms over {phase['calls']} calls")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"  {name}: {value}")
+        return "\n".join(lines)
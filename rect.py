@@ -3,28 +3,58 @@ import pyglet
 
 class Rect:
     """Get rect'd
+
+    A rect given a batch keeps a quad in it, which update() and set_color()
+    change in place, so it is drawn along with everything else in the batch.
+    Otherwise fill() draws it straight away.
     """
-    def __init__(self, x, y, width, height):
+    def __init__(self, x, y, width, height, color=None, batch=None, group=None):
         self.x = x
         self.y = y
         self.width = width
         self.height = height
+        self.vertex_list = None
+        if batch is not None:
+            self.vertex_list = batch.add(
+                4, pyglet.gl.GL_QUADS, group,
+                ('v2f/dynamic', self.vertices()),
+                ('c4B/dynamic', self._color(color or (0, 0, 0)) * 4)
+            )
+
+    @staticmethod
+    def _color(color):
+        return color if len(color) == 4 else color + (255,)
+
+    def vertices(self):
+        return (self.x, self.y,
+                self.x + self.width, self.y,
+                self.x + self.width, self.y + self.height,
+                self.x, self.y + self.height)
+
+    def update(self):
+        """Moves the batched quad to the rect's current position and size"""
+        self.vertex_list.vertices[:] = self.vertices()
+
+    def set_color(self, color):
+        self.vertex_list.colors[:] = self._color(color) * 4
+
+    def migrate(self, batch, group):
+        batch.migrate(self.vertex_list, pyglet.gl.GL_QUADS, group, batch)
+
+    def delete(self):
+        if self.vertex_list is not None:
+            self.vertex_list.delete()
+            self.vertex_list = None
 
     def fill(self, color):
-        color = color if len(color) == 4 else color + (255,)
         pyglet.graphics.draw(
                 4, pyglet.gl.GL_QUADS,
-                ('v2f',
-                    (self.x, self.y,
-                     self.x + self.width, self.y,
-                     self.x + self.width, self.y + self.height,
-                     self.x, self.y + self.height)
-                ),
-                ('c4B', color*4)
+                ('v2f', self.vertices()),
+                ('c4B', self._color(color) * 4)
             )
 
     def overlaps(self, rect2):
-        if ((self.x < rect2.x + rect2.width) and 
+        if ((self.x < rect2.x + rect2.width) and
            (self.x + self.width > rect2.x) and
            (self.y < rect2.y + rect2.height) and
            (self.y + self.height > rect2.y)):
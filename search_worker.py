@@ -0,0 +1,63 @@
+import multiprocessing
+import queue
+import threading
+
+
+def _serve(agent, requests, results):
+    """Answers (tag, state) requests with (tag, direction) until given None"""
+    agent.verbose = False
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        tag, state = request
+        results.put((tag, agent.get_move(state)))
+    if hasattr(agent, "close"):
+        agent.close()
+
+
+class SearchWorker:
+    """Runs an agent's searches in the background so the caller can keep
+    drawing frames, and hands back the moves through a queue.
+
+    submit() queues a position to search and poll() returns the move for the
+    oldest finished one without blocking. Searches run in a thread, or in a
+    process (with a pickled copy of the agent) if process is set, which keeps
+    a pure Python search from competing with the caller for the GIL.
+    """
+    def __init__(self, agent, process=False):
+        if process:
+            self.requests = multiprocessing.Queue()
+            self.results = multiprocessing.Queue()
+            self.worker = multiprocessing.Process(target=_serve,
+                                                  args=(agent, self.requests, self.results),
+                                                  daemon=True)
+        else:
+            self.requests = queue.Queue()
+            self.results = queue.Queue()
+            self.worker = threading.Thread(target=_serve,
+                                           args=(agent, self.requests, self.results),
+                                           daemon=True)
+        self.pending = 0
+        self.worker.start()
+
+    def submit(self, state, tag=None):
+        """Queues state to be searched. It mustn't be changed until its move is
+        back, unless the worker is a process, which gets its own copy."""
+        self.pending += 1
+        self.requests.put((tag, state))
+
+    def poll(self):
+        """Returns (tag, direction) for the next finished search, or None"""
+        if not self.pending:
+            return None
+        try:
+            result = self.results.get_nowait()
+        except queue.Empty:
+            return None
+        self.pending -= 1
+        return result
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
@@ -0,0 +1,187 @@
+"""Plays complete games headlessly with an agent and reports throughput.
+
+    python selfplay.py --agent MonteCarloLight --games 20 --jobs 4 \
+        --arg repetitions=50 --arg batch=True
+    python selfplay.py --agent ExpectimaxAgent --size 5 --arg max_depth=2
+"""
+import argparse
+import ast
+from collections import Counter
+import json
+import math
+import multiprocessing
+import random
+import time
+
+from agent import Agent, ExpectimaxAgent, MonteCarloAgent, MonteCarloLight, RandomAgent, State
+from bitboard import MAX_SIZE, MIN_SIZE, BitboardState
+from mcts import MCTSAgent
+from profiling import Profiler
+
+
+AGENTS = {cls.__name__: cls for cls in
+          (Agent, ExpectimaxAgent, MonteCarloAgent, MonteCarloLight, MCTSAgent, RandomAgent)}
+STATES = {"list": State, "bitboard": BitboardState}
+
+
+def new_game(state_class, size=4):
+    state = state_class([[0 for _ in range(size)] for _ in range(size)])
+    state.add_random_tile()
+    state.add_random_tile()
+    return state
+
+
+def play_game(agent, state):
+    """Plays state out with agent, returning the game's stats. A game the
+    agent stops early, with no move or an illegal one, is marked aborted."""
+    latencies = []
+    moves = 0
+    aborted = False
+    start_time = time.perf_counter()
+    while state.is_able_to_move():
+        move_start = time.perf_counter()
+        direction = agent.get_move(state)
+        latencies.append(time.perf_counter() - move_start)
+        if direction is None or not state.can_move(direction):
+            aborted = True
+            break
+        state.transition_in_place(direction)
+        moves += 1
+        if state.is_dead():
+            break
+        state.add_random_tile()
+    return {
+        "score": state.score,
+        "merges": state.merges,
+        "moves": moves,
+        "max_tile": max(max(row) for row in state.grid),
+        "duration": time.perf_counter() - start_time,
+        "latencies": latencies,
+        "aborted": aborted,
+    }
+
+
+def _play_seeded(task):
+    agent_name, agent_args, state_name, seed, profile, size = task
+    random.seed(seed)
+    agent = AGENTS[agent_name](**agent_args)
+    agent.verbose = False
+    if profile:
+        agent.profiler = Profiler(enabled=True, output=profile)
+    try:
+        return play_game(agent, new_game(STATES[state_name], size))
+    finally:
+        if hasattr(agent, "close"):
+            agent.close()
+
+
+def run(agent_name, agent_args, games, jobs=1, state_name="bitboard", seed=0, profile=None,
+        size=4):
+    """Plays games games on size x size boards, jobs at a time, and returns
+    (results, wall_time).
+
+    If profile is a path, every move's profiler report is appended to it.
+    """
+    tasks = [(agent_name, agent_args, state_name, seed + i, profile, size)
+             for i in range(games)]
+    start_time = time.perf_counter()
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(pool.imap_unordered(_play_seeded, tasks))
+    else:
+        results = [_play_seeded(task) for task in tasks]
+    return results, time.perf_counter() - start_time
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values, p in [0, 100]"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(results, wall_time):
+    """Summarizes the finished games, counting the aborted ones separately.
+    Moves and latencies include every game, as they were all searched."""
+    finished = [r for r in results if not r["aborted"]]
+    scores = [r["score"] for r in finished]
+    latencies = [l for r in results for l in r["latencies"]]
+    moves = sum(r["moves"] for r in results)
+    return {
+        "games": len(finished),
+        "aborted": len(results) - len(finished),
+        "wall_time": wall_time,
+        "games_per_sec": len(finished) / wall_time,
+        "moves_per_sec": moves / wall_time,
+        "score": {
+            "min": min(scores, default=0),
+            "mean": sum(scores) / len(scores) if scores else 0.0,
+            "p50": percentile(scores, 50),
+            "p90": percentile(scores, 90),
+            "max": max(scores, default=0),
+        },
+        "max_tile": dict(sorted(Counter(r["max_tile"] for r in finished).items())),
+        "move_latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['games']} games in {summary['wall_time']:.2f} seconds")
+    if summary["aborted"]:
+        print(f"{summary['aborted']} games aborted on an illegal move, left out of the stats below")
+    print(f"{summary['games_per_sec']:.3f} games/sec, {summary['moves_per_sec']:.1f} moves/sec")
+    score = summary["score"]
+    print(f"score: min {score['min']} mean {score['mean']:.1f} p50 {score['p50']} "
+          f"p90 {score['p90']} max {score['max']}")
+    print("max tile:")
+    for tile, count in summary["max_tile"].items():
+        print(f"  {tile:>6}: {count}")
+    latency = summary["move_latency"]
+    print(f"move latency: p50 {latency['p50'] * 1000:.2f}ms p95 {latency['p95'] * 1000:.2f}ms "
+          f"p99 {latency['p99'] * 1000:.2f}ms")
+
+
+def parse_agent_args(pairs):
+    agent_args = {}
+    for pair in pairs:
+        name, _, value = pair.partition("=")
+        try:
+            agent_args[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            agent_args[name] = value
+    return agent_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agent", choices=sorted(AGENTS), default="MonteCarloLight")
+    parser.add_argument("--arg", action="append", default=[], metavar="NAME=VALUE",
+                        help="agent constructor argument, may be repeated")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=1, help="games to play concurrently")
+    parser.add_argument("--state", choices=sorted(STATES), default="bitboard")
+    parser.add_argument("--size", type=int, default=4, choices=range(MIN_SIZE, MAX_SIZE + 1),
+                        metavar="N", help=f"play N x N boards, {MIN_SIZE} to {MAX_SIZE}")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the summary to this file")
+    parser.add_argument("--profile", help="append per-move profiler reports to this JSON lines file")
+    args = parser.parse_args()
+
+    results, wall_time = run(args.agent, parse_agent_args(args.arg), args.games,
+                             jobs=args.jobs, state_name=args.state, seed=args.seed,
+                             profile=args.profile, size=args.size)
+    summary = summarize(results, wall_time)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
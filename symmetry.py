@@ -0,0 +1,93 @@
+from move_tables import cell_bits, reverse_row, sized_moves, transpose
+
+
+def _rows(board, size):
+    bits = cell_bits(size) * size
+    mask = (1 << bits) - 1
+    return [(board >> (bits * r)) & mask for r in range(size)]
+
+
+def _join(rows, size):
+    board = 0
+    for r, row in enumerate(rows):
+        board |= row << (cell_bits(size) * size * r)
+    return board
+
+
+def mirror(board, size=4):
+    """Reflects a packed board left to right"""
+    if size != 4:
+        return _join([reverse_row(row, size) for row in _rows(board, size)], size)
+    board = ((board & 0x0F0F0F0F0F0F0F0F) << 4) | ((board >> 4) & 0x0F0F0F0F0F0F0F0F)
+    return ((board & 0x00FF00FF00FF00FF) << 8) | ((board >> 8) & 0x00FF00FF00FF00FF)
+
+
+def flip(board, size=4):
+    """Reflects a packed board top to bottom"""
+    if size != 4:
+        return _join(_rows(board, size)[::-1], size)
+    return (((board & 0xFFFF) << 48) | ((board & 0xFFFF0000) << 16) |
+            ((board >> 16) & 0xFFFF0000) | (board >> 48))
+
+
+MIRRORED = {"LEFT": "RIGHT", "RIGHT": "LEFT", "UP": "UP", "DOWN": "DOWN"}
+FLIPPED = {"LEFT": "LEFT", "RIGHT": "RIGHT", "UP": "DOWN", "DOWN": "UP"}
+TRANSPOSED = {"LEFT": "DOWN", "DOWN": "LEFT", "RIGHT": "UP", "UP": "RIGHT"}
+
+
+def apply(board, symmetry, size=4):
+    """Applies one of the 8 dihedral symmetries, numbered 0-7, to a packed board
+
+    The board is transposed if bit 2 is set, then mirrored if bit 0 is set,
+    then flipped if bit 1 is set. 0 is the identity.
+    """
+    if symmetry & 4:
+        board = transpose(board) if size == 4 else sized_moves(size).transpose(board)
+    if symmetry & 1:
+        board = mirror(board, size)
+    if symmetry & 2:
+        board = flip(board, size)
+    return board
+
+
+def all_symmetries(board, size=4):
+    if size != 4:
+        t = sized_moves(size).transpose(board)
+        m = mirror(board, size)
+        tm = mirror(t, size)
+        return [board, m, flip(board, size), flip(m, size), t, tm, flip(t, size), flip(tm, size)]
+    t = transpose(board)
+    m = mirror(board)
+    tm = mirror(t)
+    return [board, m, flip(board), flip(m), t, tm, flip(t), flip(tm)]
+
+
+def canonicalize(board, size=4):
+    """Returns (canonical_board, symmetry) where canonical_board is the smallest
+    of the board's 8 symmetries and apply(board, symmetry) == canonical_board
+    """
+    boards = all_symmetries(board, size)
+    canonical = min(boards)
+    return canonical, boards.index(canonical)
+
+
+def to_canonical(direction, symmetry):
+    """Maps a move on the original board to the same move on the transformed one"""
+    if symmetry & 4:
+        direction = TRANSPOSED[direction]
+    if symmetry & 1:
+        direction = MIRRORED[direction]
+    if symmetry & 2:
+        direction = FLIPPED[direction]
+    return direction
+
+
+def from_canonical(direction, symmetry):
+    """Maps a move on the transformed board back to the original one"""
+    if symmetry & 2:
+        direction = FLIPPED[direction]
+    if symmetry & 1:
+        direction = MIRRORED[direction]
+    if symmetry & 4:
+        direction = TRANSPOSED[direction]
+    return direction
@@ -0,0 +1,99 @@
+"""A binary file format for large lookup tables that are opened with mmap.
+
+A file is a header, a directory of tables and then each table's data:
+
+    magic    8 bytes  b"2048TBL\\0"
+    version  uint32   FORMAT_VERSION
+    count    uint32   number of tables
+    kind     16 bytes what the file holds, e.g. b"move" or b"ntuple"
+    then per table:
+    name     16 bytes
+    typecode 1 byte   an array module typecode
+    padding  7 bytes
+    offset   uint64   from the start of the file, a multiple of ALIGNMENT
+    length   uint64   number of items
+
+Everything is little endian. Opened tables are read-only memoryviews onto
+the mapped file, so opening one costs no reads, and every process that
+opens the same file shares one copy of it in the page cache.
+"""
+import mmap
+import os
+import struct
+import sys
+
+
+MAGIC = b"2048TBL\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+HEADER = struct.Struct("<8sII16s")
+ENTRY = struct.Struct("<16sc7xQQ")
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_tables(path, kind, tables):
+    """Writes tables, a list of (name, array or memoryview), to path as a kind file.
+
+    The file is written beside path and moved into place, so readers never
+    see half of it.
+    """
+    if sys.byteorder != "little":
+        raise ValueError("Tables can only be written on little endian machines")
+    entries = []
+    offset = _align(HEADER.size + ENTRY.size * len(tables))
+    for name, table in tables:
+        table = memoryview(table)
+        entries.append((name, table, offset))
+        offset = _align(offset + table.nbytes)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(tables), kind.encode()))
+        for name, table, offset in entries:
+            f.write(ENTRY.pack(name.encode(), table.format.encode(), offset, len(table)))
+        for name, table, offset in entries:
+            f.write(bytes(offset - f.tell()))
+            f.write(table)
+    os.replace(tmp_path, path)
+
+
+def open_tables(path, kind):
+    """Maps a file written by write_tables, returning {name: memoryview}.
+
+    Raises ValueError if it isn't a kind file of the current version.
+    """
+    if sys.byteorder != "little":
+        raise ValueError("Tables can only be opened on little endian machines")
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            raise ValueError(f"{path} is empty") from None
+    if len(mapped) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a table file")
+    magic, version, count, file_kind = HEADER.unpack_from(mapped)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a table file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} is version {version}, expected {FORMAT_VERSION}")
+    file_kind = file_kind.rstrip(b"\0").decode()
+    if file_kind != kind:
+        raise ValueError(f"{path} holds {file_kind} tables, not {kind}")
+    if HEADER.size + ENTRY.size * count > len(mapped):
+        raise ValueError(f"{path} is truncated")
+
+    view = memoryview(mapped)
+    tables = {}
+    for i in range(count):
+        name, typecode, offset, length = ENTRY.unpack_from(mapped, HEADER.size + i * ENTRY.size)
+        typecode = typecode.decode()
+        end = offset + struct.calcsize(typecode) * length
+        if end > len(mapped):
+            raise ValueError(f"{path} is truncated")
+        tables[name.rstrip(b"\0").decode()] = view[offset:end].cast(typecode)
+    return tables
@@ -0,0 +1,178 @@
+"""Trains an n-tuple network by TD learning on afterstates during self-play.
+
+    python train.py --games 100000 --jobs 4 --checkpoint weights.bin
+    python train.py --games 100000 --resume weights.bin --checkpoint weights.bin
+
+Each worker plays --sync games on its own copy of the weights, then the
+copies are averaged and sent back out. The weights are checkpointed every
+--checkpoint-every rounds and at the end.
+"""
+import argparse
+import multiprocessing
+import random
+import time
+
+import numpy as np
+
+from bitboard import MOVE_FUNCTIONS, empty_cells
+from ntuple import TUPLES_4, TUPLES_6, NTupleNetwork
+
+
+TUPLE_SETS = {"4": TUPLES_4, "6": TUPLES_6}
+
+
+def add_random_tile(board, rng):
+    cell = rng.choice(empty_cells(board))
+    exponent = 2 if rng.random() < 0.1 else 1
+    return board | (exponent << (4 * cell))
+
+
+def best_move(network, board):
+    """Returns (reward, afterstate, value) for the move maximizing reward plus
+    the afterstate's value, or None if no move changes the board"""
+    evaluate = network.evaluate
+    best = None
+    best_value = -float("inf")
+    for move in MOVE_FUNCTIONS:
+        afterstate, _, reward = move(board)
+        if afterstate == board:
+            continue
+        value = evaluate(afterstate)
+        if reward + value > best_value:
+            best_value = reward + value
+            best = reward, afterstate, value
+    return best
+
+
+def play_game(network, alpha, lambd, rng):
+    """Plays one greedy game, learning from it, and returns (score, max_exponent).
+
+    With lambd 0 every afterstate is updated towards the next reward plus the
+    next afterstate's value as the game goes (TD(0)). Otherwise the game's
+    afterstates and rewards are kept and each is updated towards its
+    lambda-return once the game is over.
+    """
+    board = add_random_tile(add_random_tile(0, rng), rng)
+    score = 0
+    afterstates = []
+    rewards = []
+    move = best_move(network, board)
+    while move is not None:
+        reward, afterstate, _ = move
+        score += reward
+        board = add_random_tile(afterstate, rng)
+        move = best_move(network, board)
+        if lambd:
+            afterstates.append(afterstate)
+            rewards.append(move[0] if move else 0)
+            continue
+        if move is None:
+            target = 0.0
+        else:
+            target = move[0] + move[2]
+        network.update(afterstate, alpha * (target - network.evaluate(afterstate)))
+    if lambd:
+        update_lambda(network, afterstates, rewards, alpha, lambd)
+    max_exponent = max((board >> (4 * i)) & 0xF for i in range(16))
+    return score, max_exponent
+
+
+def update_lambda(network, afterstates, rewards, alpha, lambd):
+    """Updates every afterstate of a game towards its lambda-return, working
+    back from the end where the return of the last afterstate is 0"""
+    target = 0.0
+    next_value = 0.0
+    for afterstate, reward in zip(reversed(afterstates), reversed(rewards)):
+        # rewards[t] is what the move made from afterstates[t]'s successor earned
+        target = reward + (1 - lambd) * next_value + lambd * target
+        value = network.evaluate(afterstate)
+        network.update(afterstate, alpha * (target - value))
+        next_value = value
+
+
+def _train_games(task):
+    network, games, alpha, lambd, seed = task
+    rng = random.Random(seed)
+    results = [play_game(network, alpha, lambd, rng) for _ in range(games)]
+    return network.weights, results
+
+
+def merge(weight_sets):
+    """Averages the workers' copies of each weight table"""
+    merged = []
+    for tables in zip(*weight_sets):
+        mean = np.mean([np.frombuffer(table, dtype=np.float32) for table in tables], axis=0)
+        merged.append(mean.astype(np.float32))
+    return merged
+
+
+def train(network, games, jobs=1, sync=1000, alpha=0.1, lambd=0.0, seed=0,
+          checkpoint=None, checkpoint_every=10, log=print):
+    """Plays games self-play games in rounds of sync games per worker, merging
+    the workers' weights into network after each round"""
+    rng = random.Random(seed)
+    played = 0
+    rounds = 0
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        while played < games:
+            start_time = time.perf_counter()
+            per_worker = [min(sync, max(0, games - played - i * sync)) for i in range(jobs)]
+            tasks = [(network, n, alpha, lambd, rng.getrandbits(32)) for n in per_worker if n]
+            if pool is None:
+                # The games were learnt from in place
+                outputs = [_train_games(task) for task in tasks]
+            else:
+                outputs = pool.map(_train_games, tasks)
+                for table, mean in zip(network.weights, merge([w for w, _ in outputs])):
+                    np.frombuffer(table, dtype=np.float32)[:] = mean
+            results = [r for _, round_results in outputs for r in round_results]
+            played += len(results)
+            rounds += 1
+
+            elapsed = time.perf_counter() - start_time
+            scores = [score for score, _ in results]
+            reached = sum(exponent >= 11 for _, exponent in results) / len(results)
+            log(f"{played} games: mean score {sum(scores) / len(scores):.0f}, "
+                f"max {max(scores)}, 2048 rate {reached:.1%}, "
+                f"{len(results) / elapsed:.1f} games/sec")
+            if checkpoint and rounds % checkpoint_every == 0:
+                network.save(checkpoint)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if checkpoint:
+        network.save(checkpoint)
+    return network
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--jobs", type=int, default=1, help="self-play worker processes")
+    parser.add_argument("--sync", type=int, default=1000,
+                        help="games each worker plays between weight merges")
+    parser.add_argument("--alpha", type=float, default=0.1, help="learning rate")
+    parser.add_argument("--lambda", dest="lambd", type=float, default=0.0,
+                        help="TD(lambda) trace decay, 0 for online TD(0)")
+    parser.add_argument("--tuples", choices=sorted(TUPLE_SETS), default="4",
+                        help="tuple set for new weights, resumed ones keep theirs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--resume", help="start from these saved weights")
+    parser.add_argument("--checkpoint", help="save the weights here")
+    parser.add_argument("--checkpoint-every", type=int, default=10,
+                        help="rounds between checkpoints")
+    args = parser.parse_args()
+
+    if args.resume:
+        network = NTupleNetwork.load(args.resume, writable=True)
+    else:
+        network = NTupleNetwork(TUPLE_SETS[args.tuples])
+    train(network, args.games, jobs=args.jobs, sync=args.sync, alpha=args.alpha,
+          lambd=args.lambd, seed=args.seed, checkpoint=args.checkpoint,
+          checkpoint_every=args.checkpoint_every)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from itertools import islice
+
+
+class TranspositionTable:
+    """A bounded cache of search results keyed on (board key, remaining depth)
+
+    replacement is either "lru", which always evicts the least recently used
+    entry, or "depth", which evicts the shallowest of the depth_window least
+    recently used entries, the least recently used of those on a tie.
+    """
+    def __init__(self, max_size=100000, replacement="lru", depth_window=8):
+        if replacement not in ("lru", "depth"):
+            raise ValueError(f"Unknown replacement policy {replacement}")
+        self.max_size = max_size
+        self.replacement = replacement
+        self.depth_window = depth_window
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, depth):
+        entry = self.entries.get((key, depth))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((key, depth))
+        self.hits += 1
+        return entry
+
+    def put(self, key, depth, value):
+        entries = self.entries
+        if (key, depth) in entries:
+            entries.move_to_end((key, depth))
+        elif len(entries) >= self.max_size:
+            if self.replacement == "depth":
+                oldest = islice(entries, self.depth_window)
+                del entries[min(oldest, key=lambda entry: entry[1])]
+            else:
+                entries.popitem(last=False)
+            self.evictions += 1
+        entries[(key, depth)] = value
+
+    def clear(self):
+        self.entries.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return (f"{len(self)}/{self.max_size} entries, {self.hits} hits, {self.misses} misses, "
+                f"{self.evictions} evictions ({self.hit_rate():.1%} hit rate)")